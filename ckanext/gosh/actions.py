@@ -1,5 +1,8 @@
 # encoding: utf-8
 
+import base64
+import copy
+import datetime
 import logging
 import json
 
@@ -12,13 +15,26 @@ import ckan.logic.action
 import ckan.logic.schema
 import ckan.lib.dictization.model_dictize as model_dictize
 import ckan.lib.navl.dictization_functions
+from ckan.lib.navl.validators import ignore_missing
+from ckan.logic.validators import list_of_strings
 import ckan.model as model
 import ckan.model.misc as misc
 import ckan.plugins as plugins
 import ckan.lib.search as search
-import ckan.authz as authz
 
-from ckan.common import _
+from ckan.common import _, config
+
+from ckanext.gosh import autocomplete
+from ckanext.gosh import bulk
+from ckanext.gosh import export as gosh_export
+from ckanext.gosh import facets as gosh_facets
+from ckanext.gosh import helpers as gosh_helpers
+from ckanext.gosh.metrics import metrics
+from ckanext.gosh import restricted
+from ckanext.gosh.replica import replica
+from ckanext.gosh import scope as gosh_scope
+from ckanext.gosh.search_cache import search_cache
+from ckanext.gosh import users as gosh_users
 
 log = logging.getLogger(__name__)
 
@@ -36,9 +52,45 @@ _desc = sqlalchemy.desc
 _case = sqlalchemy.case
 _text = sqlalchemy.text
 
+_json_loads = json.loads
+
+
+def set_json_decoder(name):
+    '''Picks the decoder for the package dicts stored in Solr.
+
+    "ujson" is much faster than the standard library on large dicts, if it
+    is installed.
+    '''
+    global _json_loads
+    _json_loads = json.loads
+    if name == 'ujson':
+        try:
+            import ujson
+            _json_loads = ujson.loads
+        except ImportError:
+            log.warning('ujson is not installed, decoding search results '
+                        'with json')
+    elif name not in (None, 'json'):
+        log.warning('Unknown JSON decoder %s, using json', name)
+
+
+def _fields_list(key, data, errors, context):
+    '''Like ``list_of_strings``, but also takes the space or comma
+    separated string of field names a GET request sends.'''
+    value = data.get(key)
+    if isinstance(value, basestring):
+        data[key] = value.replace(',', ' ').split()
+    list_of_strings(key, data, errors, context)
+
+
+def _package_search_schema():
+    schema = logic.schema.default_package_search_schema()
+    schema['fl'] = [ignore_missing, _fields_list]
+    return schema
 
 
 @logic.side_effect_free
+@metrics.timed('package_autocomplete')
 def package_autocomplete(context, data_dict):
 
     model = context['model']
@@ -48,42 +100,61 @@ def package_autocomplete(context, data_dict):
     limit = data_dict.get('limit', 10)
     q = data_dict['q']
 
-    like_q = u"%s%%" % q
+    q_lower = q.lower()
+
+    if (config.get('ckanext.gosh.autocomplete_engine') == 'memory' and
+            autocomplete.index.ensure_ready()):
+        with metrics.span('package_autocomplete.memory'):
+            rows = autocomplete.index.search(
+                q, limit, include_restricted=not restricted.hidden_for(
+                    context.get("user", None)))
+        return [_autocomplete_dict(name, title, q_lower)
+                for name, title in rows]
 
-    query = model.Session.query(model.Package)
+    like_q = u"%s%%" % misc.escape_sql_like_special_characters(q)
+
+    query = model.Session.query(model.Package.name, model.Package.title)
     query = query.filter(model.Package.state == 'active')
     query = query.filter(model.Package.private == False)
-    query = query.filter(_or_(model.Package.name.ilike(like_q),
-                              model.Package.title.ilike(like_q)))
-    
+    if config.get('ckanext.gosh.autocomplete_index') == 'prefix':
+        # Matches the lower(...) text_pattern_ops indexes created by
+        # `paster gosh create-indexes prefix`
+        like_q = like_q.lower()
+        query = query.filter(_or_(_func.lower(model.Package.name).like(like_q),
+                                  _func.lower(model.Package.title).like(like_q)))
+    else:
+        query = query.filter(_or_(model.Package.name.ilike(like_q),
+                                  model.Package.title.ilike(like_q)))
+
+    if restricted.hidden_for(context.get("user", None)):
+        query = query.filter(~restricted.sql_clause(model.Package.id))
+
     query = query.limit(limit)
 
-    q_lower = q.lower()
-    pkg_list = []
-    for package in query:
-        if package.name.startswith(q_lower):
-            match_field = 'name'
-            match_displayed = package.name
-        else:
-            match_field = 'title'
-            match_displayed = '%s (%s)' % (package.title, package.name)
-        result_dict = {
-            'name': package.name,
-            'title': package.title,
-            'match_field': match_field,
-            'match_displayed': match_displayed}
-        if not context.get("user", None) and package.extras.get("restricted", 0) == "1":
-            continue
-        pkg_list.append(result_dict)
+    with metrics.span('package_autocomplete.sql'):
+        rows = replica.run(lambda session: query.with_session(session).all())
+    return [_autocomplete_dict(name, title, q_lower) for name, title in rows]
+
 
-    return pkg_list
+def _autocomplete_dict(name, title, q_lower):
+    if name.startswith(q_lower):
+        match_field = 'name'
+        match_displayed = name
+    else:
+        match_field = 'title'
+        match_displayed = '%s (%s)' % (title, name)
+    return {
+        'name': name,
+        'title': title,
+        'match_field': match_field,
+        'match_displayed': match_displayed}
 
 
 @logic.side_effect_free
+@metrics.timed('package_search')
 def package_search(context, data_dict):
 
-    schema = (context.get('schema') or
-              logic.schema.default_package_search_schema())
+    schema = context.get('schema') or _package_search_schema()
     data_dict, errors = _validate(data_dict, schema, context)
     # put the extras back into the data_dict so that the search can
     # report needless parameters
@@ -92,8 +163,14 @@ def package_search(context, data_dict):
     if errors:
         raise ValidationError(errors)
 
+    # Deep paging with Solr's cursorMark instead of start, see
+    # gosh_export.cursor_search
+    cursor_mark = data_dict.pop('cursor_mark', None)
+    if cursor_mark and data_dict.get('start'):
+        raise ValidationError(
+            {'start': [_('Can not be used with cursor_mark')]})
+
     model = context['model']
-    session = context['session']
     user = context.get('user')
 
     _check_access('package_search', context, data_dict)
@@ -114,16 +191,25 @@ def package_search(context, data_dict):
 
     if data_dict.get('sort') in (None, 'rank'):
         data_dict['sort'] = 'score desc, metadata_modified desc'
+    if cursor_mark:
+        data_dict['sort'] = gosh_export.cursor_sort(data_dict['sort'])
 
     results = []
+    cache_key = None
+    next_cursor_mark = cursor_mark
     if not abort:
         if asbool(data_dict.get('use_default_schema')):
             data_source = 'data_dict'
         else:
             data_source = 'validated_data_dict'
         data_dict.pop('use_default_schema', None)
-        # return a list of package ids
-        data_dict['fl'] = 'id {0}'.format(data_source)
+
+        # A projection of stored Solr fields skips the package dict blob
+        result_fl = data_dict.get('fl')
+        if not result_fl:
+            data_dict['fl'] = 'id {0}'.format(data_source)
+        else:
+            data_dict['fl'] = ' '.join(result_fl)
 
         # we should remove any mention of capacity from the fq and
         # instead set it to only retrieve public datasets
@@ -133,66 +219,68 @@ def package_search(context, data_dict):
         include_private = asbool(data_dict.pop('include_private', False))
         include_drafts = asbool(data_dict.pop('include_drafts', False))
 
-        capacity_fq = 'capacity:"public"'
-        if include_private and authz.is_sysadmin(user):
-            capacity_fq = None
-        elif include_private and user:
-            orgs = logic.get_action('organization_list_for_user')(
-                {'user': user}, {'permission': 'read'})
-            if orgs:
-                capacity_fq = '({0} OR owner_org:({1}))'.format(
-                    capacity_fq,
-                    ' OR '.join(org['id'] for org in orgs))
-            if include_drafts:
-                capacity_fq = '({0} OR creator_user_id:({1}))'.format(
-                    capacity_fq,
-                    authz.get_user_id_for_username(user))
-
-        if capacity_fq:
-            fq = ' '.join(p for p in fq.split() if 'capacity:' not in p)
-            data_dict['fq'] = fq + ' ' + capacity_fq
+        # sysadmin flag, user id and readable orgs, resolved once per
+        # request and cached across requests
+        with metrics.span('package_search.scope'):
+            scope = gosh_scope.get_scope(user)
 
-        fq = data_dict.get('fq', '')
-        if include_drafts:
-            user_id = authz.get_user_id_for_username(user, allow_none=True)
-            if authz.is_sysadmin(user):
-                data_dict['fq'] = fq + ' +state:(active OR draft)'
-            elif user_id:
-                # Query to return all active datasets, and all draft datasets
-                # for this user.
-                data_dict['fq'] = fq + \
-                    ' ((creator_user_id:{0} AND +state:(draft OR active))' \
-                    ' OR state:active)'.format(user_id)
-        elif not authz.is_sysadmin(user):
-            data_dict['fq'] = fq + ' +state:active'
+        fq = _permission_fq(fq, scope, include_private, include_drafts)
+        if fq:
+            data_dict['fq'] = fq
+
+        if search_cache.enabled:
+            cache_key = search_cache.key(
+                dict(data_dict, for_view=bool(context.get('for_view')),
+                     cursor_mark=cursor_mark),
+                scope.cache_key(include_drafts))
+            search_results = search_cache.get(cache_key)
+            if search_results is not None:
+                return search_results
 
         # Pop these ones as Solr does not need them
         extras = data_dict.pop('extras', None)
 
-        query = search.query_for(model.Package)
-        query.run(data_dict)
+        with metrics.span('package_search.solr'):
+            if cursor_mark:
+                count, solr_results, facets, next_cursor_mark = \
+                    gosh_export.cursor_search(data_dict, cursor_mark)
+            else:
+                query = search.query_for(model.Package)
+                query.run(data_dict)
+                count = query.count
+                solr_results = query.results
+                facets = query.facets
 
         # Add them back so extensions can use them on after_search
         data_dict['extras'] = extras
 
-        for package in query.results:
-            # get the package object
-            package_dict = package.get(data_source)
-            ## use data in search index if there
-            if package_dict:
-                # the package_dict still needs translating when being viewed
-                package_dict = json.loads(package_dict)
-                if context.get('for_view'):
+        if result_fl:
+            for package in solr_results:
+                if isinstance(package, basestring):
+                    # Core returns bare values for fl=id and fl=name
+                    package = {result_fl[0]: package}
+                if package.get('extras'):
+                    package.update(package['extras'])
+                    package.pop('extras')
+                results.append(package)
+        else:
+            with metrics.span('package_search.json_loads'):
+                for package in solr_results:
+                    # get the package object
+                    package_dict = package.get(data_source)
+                    ## use data in search index if there
+                    if package_dict:
+                        results.append(_json_loads(package_dict))
+                    else:
+                        log.error('No package_dict is coming from solr for '
+                                  'package id %s', package['id'])
+            # the package_dict still needs translating when being viewed
+            if context.get('for_view'):
+                with metrics.span('package_search.before_view'):
                     for item in plugins.PluginImplementations(
                             plugins.IPackageController):
-                        package_dict = item.before_view(package_dict)
-                results.append(package_dict)
-            else:
-                log.error('No package_dict is coming from solr for package '
-                          'id %s', package['id'])
-
-        count = query.count
-        facets = query.facets
+                        results = [item.before_view(package_dict)
+                                   for package_dict in results]
     else:
         count = 0
         facets = {}
@@ -204,60 +292,70 @@ def package_search(context, data_dict):
         'results': results,
         'sort': data_dict['sort']
     }
+    if cursor_mark:
+        # The same mark again once there are no more results
+        search_results['next_cursor_mark'] = next_cursor_mark
 
-    # create a lookup table of group name to title for all the groups and
-    # organizations in the current search's facets.
-    group_names = []
-    for field_name in ('groups', 'organization'):
-        group_names.extend(facets.get(field_name, {}).keys())
-
-    groups = (session.query(model.Group.name, model.Group.title)
-                    .filter(model.Group.name.in_(group_names))
-                    .all()
-              if group_names else [])
-    group_titles_by_name = dict(groups)
-
-    # Transform facets into a more useful data structure.
-    restructured_facets = {}
-    for key, value in facets.items():
-        restructured_facets[key] = {
-            'title': key,
-            'items': []
-        }
-        for key_, value_ in value.items():
-            new_facet_dict = {}
-            new_facet_dict['name'] = key_
-            if key in ('groups', 'organization'):
-                display_name = group_titles_by_name.get(key_, key_)
-                display_name = display_name if display_name and display_name.strip() else key_
-                new_facet_dict['display_name'] = display_name
-            elif key == 'license_id':
-                license = model.Package.get_license_register().get(key_)
-                if license:
-                    new_facet_dict['display_name'] = license.title
-                else:
-                    new_facet_dict['display_name'] = key_
-            else:
-                new_facet_dict['display_name'] = key_
-            new_facet_dict['count'] = value_
-            restructured_facets[key]['items'].append(new_facet_dict)
-    search_results['search_facets'] = restructured_facets
+    # Display names come from cached title maps, so this needs no queries
+    with metrics.span('package_search.facets'):
+        search_results['search_facets'] = gosh_facets.restructure(facets)
 
     # check if some extension needs to modify the search results
-    for item in plugins.PluginImplementations(plugins.IPackageController):
-        search_results = item.after_search(search_results, data_dict)
+    with metrics.span('package_search.after_search'):
+        for item in plugins.PluginImplementations(
+                plugins.IPackageController):
+            search_results = item.after_search(search_results, data_dict)
 
     # After extensions have had a chance to modify the facets, sort them by
-    # display name.
+    # display name. The items come sorted already, which makes this linear
+    # unless an extension changed them.
     for facet in search_results['search_facets']:
         search_results['search_facets'][facet]['items'] = sorted(
             search_results['search_facets'][facet]['items'],
             key=lambda facet: facet['display_name'], reverse=True)
 
+    if cache_key:
+        search_cache.set(cache_key, search_results)
+
     return search_results
 
 
+def _permission_fq(fq, scope, include_private=False, include_drafts=False):
+    '''Adds the capacity and state filters for what ``scope`` may see to
+    the filter query ``fq``.'''
+    capacity_fq = 'capacity:"public"'
+    if include_private and scope.sysadmin:
+        capacity_fq = None
+    elif include_private and scope.user:
+        if scope.org_ids:
+            capacity_fq = '({0} OR owner_org:({1}))'.format(
+                capacity_fq,
+                ' OR '.join(scope.org_ids))
+        if include_drafts and scope.user_id:
+            capacity_fq = '({0} OR creator_user_id:({1}))'.format(
+                capacity_fq,
+                scope.user_id)
+
+    if capacity_fq:
+        fq = ' '.join(p for p in fq.split() if 'capacity:' not in p)
+        fq = fq + ' ' + capacity_fq
+
+    if include_drafts:
+        if scope.sysadmin:
+            fq = fq + ' +state:(active OR draft)'
+        elif scope.user_id:
+            # Query to return all active datasets, and all draft datasets
+            # for this user.
+            fq = fq + \
+                ' ((creator_user_id:{0} AND +state:(draft OR active))' \
+                ' OR state:active)'.format(scope.user_id)
+    elif not scope.sysadmin:
+        fq = fq + ' +state:active'
+    return fq
+
+
 @logic.side_effect_free
+@metrics.timed('resource_search')
 def resource_search(context, data_dict):
 
     model = context['model']
@@ -297,12 +395,23 @@ def resource_search(context, data_dict):
     order_by = data_dict.get('order_by')
     offset = data_dict.get('offset')
     limit = data_dict.get('limit')
+    cursor = data_dict.get('cursor')
+    if limit is not None:
+        # GET requests pass it as a string
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            raise ValidationError({'limit': [_('Must be an integer')]})
 
     q = model.Session.query(model.Resource) \
          .join(model.Package) \
          .filter(model.Package.state == 'active') \
          .filter(model.Package.private == False) \
-         .filter(model.Resource.state == 'active') \
+         .filter(model.Resource.state == 'active')
+
+    if restricted.hidden_for(context.get("user", None)):
+        # Hide resources of restricted datasets before counting and paging
+        q = q.filter(~restricted.sql_clause(model.Package.id))
 
     resource_fields = model.Resource.get_columns()
     for field, terms in fields.items():
@@ -335,6 +444,8 @@ def resource_search(context, data_dict):
 
             # Resource extras are stored in a json blob.  So searching for
             # matching fields is a bit trickier.  See the docstring.
+            # `paster gosh create-indexes resource-extras` adds a trigram
+            # index these patterns can use instead of a sequential scan.
             elif field in model.Resource.get_extra_columns():
                 model_attr = getattr(model.Resource, 'extras')
 
@@ -350,36 +461,119 @@ def resource_search(context, data_dict):
             else:
                 q = q.filter(model_attr.ilike('%' + unicode(term) + '%'))
 
+    if cursor is not None:
+        # Keyset pagination: seek past the last row of the previous page
+        # instead of counting and skipping `offset` rows
+        with metrics.span('resource_search.query'):
+            results, next_cursor = replica.run(
+                lambda session: _resource_keyset_page(
+                    model, q.with_session(session), order_by, cursor,
+                    limit or 100))
+        if not context.get('search_query', False):
+            results = model_dictize.resource_list_dictize(results, context)
+        return {'results': results,
+                'next_cursor': next_cursor}
+
     if order_by is not None:
         if hasattr(model.Resource, order_by):
             q = q.order_by(getattr(model.Resource, order_by))
 
-    count = q.count()
-    q = q.offset(offset)
-    q = q.limit(limit)
+    def page(session):
+        page_q = q.with_session(session)
+        count = page_q.count()
+        page_q = page_q.offset(offset)
+        page_q = page_q.limit(limit)
 
-    results = []
-    for result in q:
-        if isinstance(result, tuple) \
-                and isinstance(result[0], model.DomainObject):
-            # This is the case for order_by rank due to the add_column.
-            if result[0].package.extras.get("restricted", 0) == "1" and not context.get("user", None):
-                continue
-            results.append(result[0])
-        else:
-            if result.package.extras.get("restricted", 0) == "1" and not context.get("user", None):
-                continue
-            results.append(result)
+        results = []
+        for result in page_q:
+            if isinstance(result, tuple) \
+                    and isinstance(result[0], model.DomainObject):
+                # This is the case for order_by rank due to the add_column.
+                results.append(result[0])
+            else:
+                results.append(result)
+        return count, results
+
+    with metrics.span('resource_search.query'):
+        count, results = replica.run(page)
 
     # If run in the context of a search query, then don't dictize the results.
     if not context.get('search_query', False):
-        results = model_dictize.resource_list_dictize(results, context)
+        with metrics.span('resource_search.dictize'):
+            results = model_dictize.resource_list_dictize(results, context)
 
     return {'count': count,
             'results': results}
 
 
+def _resource_keyset_page(model, q, order_by, cursor, limit):
+    id_column = model.resource_table.c.id
+    column = None
+    if order_by and order_by != 'id' and \
+            order_by in model.resource_table.c.keys():
+        column = model.resource_table.c[order_by]
+
+    if cursor not in ('', '*'):
+        last_value, last_id = _decode_cursor(cursor, column)
+        if column is None:
+            q = q.filter(id_column > last_id)
+        elif last_value is None:
+            # NULLs sort last, so only NULL rows can follow a NULL
+            q = q.filter(_and_(column == None, id_column > last_id))
+        else:
+            q = q.filter(_or_(column > last_value,
+                              _and_(column == last_value,
+                                    id_column > last_id),
+                              column == None))
+
+    if column is not None:
+        q = q.order_by(column.asc())
+    q = q.order_by(id_column.asc()).limit(limit)
+
+    results = q.all()
+    next_cursor = None
+    if len(results) == limit:
+        last = results[-1]
+        next_cursor = _encode_cursor(
+            getattr(last, order_by) if column is not None else None, last.id)
+    return results, next_cursor
+
+
+def _encode_cursor(value, id):
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, id]))
+
+
+def _decode_cursor(cursor, column):
+    try:
+        value, id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if value is not None and column is not None and \
+                isinstance(column.type, sqlalchemy.DateTime):
+            value = datetime.datetime.strptime(
+                value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value
+                else '%Y-%m-%dT%H:%M:%S')
+    except (TypeError, ValueError):
+        raise ValidationError({'cursor': _('Invalid cursor')})
+    return value, id
+
+
+def iter_resource_search(context, data_dict, batch_size=500):
+    '''Yields the results of resource_search in batches of dictized
+    resources, walking them with keyset pagination. Memory use is bounded
+    by the batch size, however many resources match.'''
+    data_dict = dict(data_dict, cursor='*', limit=batch_size)
+    while True:
+        page = resource_search(context, data_dict)
+        if page['results']:
+            yield page['results']
+        if not page['next_cursor']:
+            return
+        data_dict['cursor'] = page['next_cursor']
+
+
 @logic.side_effect_free
+@metrics.timed('user_list')
 def user_list(context, data_dict):
     user = context.get('user', None)
     q = model.Session.query(model.User).filter(model.User.id=='')
@@ -388,6 +582,386 @@ def user_list(context, data_dict):
 
     user = model.User.get(user)
     if user.sysadmin:
+        order_by = data_dict.get('order_by', 'name')
+        if data_dict.get('cursor') is not None:
+            # Keyset pages of lean user dicts, cached for a short while
+            try:
+                limit = int(data_dict.get('limit', 100))
+            except (TypeError, ValueError):
+                raise ValidationError({'limit': [_('Must be an integer')]})
+            return replica.run(lambda session: gosh_users.keyset_page(
+                data_dict.get('q'), data_dict['cursor'], limit, user.name,
+                session))
+        if context.get('return_query') and \
+                order_by in gosh_users.LEAN_ORDER_BY:
+            # The user list page only renders names and links. The query
+            # runs after this returns, so without the fallback of
+            # replica.run
+            return gosh_users.lean_query(data_dict.get('q'), order_by,
+                                         user.name, replica.session())
         return logic.action.get.user_list(context, data_dict)
 
     return q
+
+
+def catalogue_export(context, data_dict):
+    '''Exports the datasets the user may see as JSON Lines or CSV.
+
+    Returns an iterator of lines instead of a dict, for callers streaming
+    it to a file or a response, such as ``paster gosh export`` and
+    ``/gosh/export.<format>``. The action API can't encode that, so it is
+    not registered as an action; call it directly.
+
+    Datasets are read from Solr in pages of ``batch_size`` with cursorMark
+    paging, with the filters package_search applies for the user: the
+    search params go through the ``IPackageController.before_search``
+    hooks first, so with the gosh plugin private datasets the user can
+    read are always included, as they are in package_search. Unlike
+    package_search, ``ext_`` params are not passed on to the hooks.
+
+    :param format: "jsonl" (default), one dataset dict per line, or "csv"
+    :type format: string
+    :param q: as for package_search (optional)
+    :type q: string
+    :param fq: as for package_search (optional)
+    :type fq: string
+    :param include_private: as for package_search (default: False, but
+        the gosh plugin's before_search sets it)
+    :type include_private: bool
+    :param include_drafts: as for package_search (default: False)
+    :type include_drafts: bool
+    :param fields: stored Solr fields exported to CSV, as a list or a space
+        or comma separated string (optional)
+    :type fields: list of strings
+    :param batch_size: datasets per Solr page, up to 1000 (default: 250)
+    :type batch_size: int
+
+    :rtype: iterator of strings
+    '''
+    _check_access('package_search', context, data_dict)
+
+    format = data_dict.get('format') or 'jsonl'
+    if format not in gosh_export.FORMATS:
+        raise ValidationError({'format': [_('Must be jsonl or csv')]})
+    try:
+        batch_size = min(1000, max(1, int(data_dict.get('batch_size', 250))))
+    except ValueError:
+        raise ValidationError({'batch_size': [_('Must be an integer')]})
+    fields = data_dict.get('fields')
+    if isinstance(fields, basestring):
+        fields = fields.replace(',', ' ').split()
+
+    search_params = {'q': data_dict.get('q'), 'fq': data_dict.get('fq', ''),
+                     'include_private': data_dict.get('include_private',
+                                                      False),
+                     'include_drafts': data_dict.get('include_drafts', False),
+                     'extras': {}}
+    # check if some extension needs to modify the search params, as
+    # package_search does
+    for item in plugins.PluginImplementations(plugins.IPackageController):
+        search_params = item.before_search(search_params)
+    if search_params.get('abort_search', False):
+        return iter([])
+
+    return gosh_export.export_lines(
+        gosh_scope.get_scope(context.get('user')), format,
+        q=search_params.get('q'), fq=search_params.get('fq'),
+        include_private=asbool(search_params.get('include_private', False)),
+        include_drafts=asbool(search_params.get('include_drafts', False)),
+        fields=fields, batch_size=batch_size)
+
+
+# Datasets fetched from Solr per query, below its 1000 rows limit
+_SHOW_MANY_BATCH = 200
+
+
+@logic.side_effect_free
+@metrics.timed('package_show_many')
+def package_show_many(context, data_dict):
+    '''Returns many datasets at once, as package_show would return them.
+
+    The datasets are looked up with one query, the user's access and the
+    restricted rule are checked for the whole set at once, and the dataset
+    dicts come from Solr, in batches of 200. Only datasets missing from
+    the index or changed since they were indexed are shown one by one.
+
+    Ids that don't exist or the user may not see are left out. Deleted
+    datasets are only shown to sysadmins.
+
+    :param ids: ids or names of the datasets, as a list or a comma separated
+        string
+    :type ids: list of strings
+
+    :returns: the dataset dicts, in the order of ``ids``
+    :rtype: list of dictionaries
+    '''
+    model = context['model']
+    user = context.get('user')
+
+    ids = logic.get_or_bust(data_dict, 'ids')
+    if isinstance(ids, basestring):
+        ids = [id.strip() for id in ids.split(',') if id.strip()]
+    if not isinstance(ids, list):
+        raise ValidationError({'ids': [_('Must be a list of ids')]})
+
+    _check_access('gosh_package_show_many', context, data_dict)
+
+    scope = gosh_scope.get_scope(user)
+    hide_restricted = restricted.hidden_for(user)
+
+    with metrics.span('package_show_many.db'):
+        rows = model.Session.query(
+            model.Package.id, model.Package.name, model.Package.state,
+            model.Package.private, model.Package.owner_org,
+            model.Package.creator_user_id, model.Package.metadata_modified) \
+            .filter(_or_(model.Package.id.in_(ids),
+                         model.Package.name.in_(ids))).all()
+
+    visible = {}
+    for row in rows:
+        if not scope.sysadmin:
+            if row.private and row.owner_org not in scope.org_ids:
+                continue
+            if row.state != 'active' and not (
+                    row.state == 'draft' and scope.user_id and
+                    row.creator_user_id == scope.user_id):
+                continue
+            if hide_restricted and row.id in restricted.restricted_ids:
+                continue
+        visible[row.id] = row
+
+    package_dicts = {}
+    with metrics.span('package_show_many.solr'):
+        visible_ids = list(visible)
+        for start in range(0, len(visible_ids), _SHOW_MANY_BATCH):
+            batch = visible_ids[start:start + _SHOW_MANY_BATCH]
+            query = search.query_for(model.Package)
+            query.run({
+                'q': '*:*',
+                'fq': '+state:* +id:({0})'.format(' OR '.join(
+                    '"{0}"'.format(id) for id in batch)),
+                'fl': 'id metadata_modified validated_data_dict',
+                'rows': len(batch),
+                'facet': 'false'})
+            for result in query.results:
+                row = visible.get(result.get('id'))
+                # The index may lag behind the database, as in package_show
+                indexed = _to_milliseconds(result.get('metadata_modified'))
+                if row is None or not result.get('validated_data_dict') or \
+                        indexed is None or \
+                        indexed != _to_milliseconds(row.metadata_modified):
+                    continue
+                package_dicts[row.id] = _json_loads(
+                    result['validated_data_dict'])
+
+    for id, package_dict in package_dicts.items():
+        package_dicts[id] = _after_show_many(context, package_dict)
+
+    missing = [id for id in visible_ids if id not in package_dicts]
+    if missing:
+        with metrics.span('package_show_many.package_show'):
+            for id in missing:
+                try:
+                    package_dicts[id] = logic.get_action('package_show')(
+                        dict(context), {'id': id})
+                except (logic.NotFound, logic.NotAuthorized):
+                    pass
+
+    if hide_restricted:
+        # Catches datasets restricted since the id set was last loaded
+        package_dicts = dict(
+            (id, package_dict) for id, package_dict in package_dicts.items()
+            if not restricted.is_restricted_dict(package_dict))
+
+    by_key = {}
+    for row in visible.values():
+        if row.id in package_dicts:
+            by_key[row.id] = by_key[row.name] = package_dicts[row.id]
+    return [by_key[id] for id in ids if id in by_key]
+
+
+def _to_milliseconds(value):
+    '''A datetime, or an ISO date string as Solr returns it (e.g.
+    "2018-01-02T03:04:05.12Z"), truncated to the milliseconds Solr keeps.
+    None if it can't be read.'''
+    if isinstance(value, basestring):
+        date, dot, fraction = value.rstrip('Z').partition('.')
+        if fraction and not fraction.isdigit():
+            return None
+        try:
+            value = datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%S')
+        except ValueError:
+            return None
+        value = value.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+    if not isinstance(value, datetime.datetime):
+        return None
+    return value.replace(microsecond=value.microsecond // 1000 * 1000,
+                         tzinfo=None)
+
+
+def _after_show_many(context, package_dict):
+    # What package_show does with a dict from the index. There is no
+    # 'package' in the context, the restricted rule was applied to the set.
+    if context.get('for_view'):
+        for item in plugins.PluginImplementations(plugins.IPackageController):
+            package_dict = item.before_view(package_dict)
+    for item in plugins.PluginImplementations(plugins.IResourceController):
+        for resource_dict in package_dict.get('resources', []):
+            item.before_show(resource_dict)
+    for item in plugins.PluginImplementations(plugins.IPackageController):
+        item.after_show(context, package_dict)
+    return package_dict
+
+
+def package_bulk_upsert(context, data_dict):
+    '''Creates or updates many datasets at once.
+
+    Datasets with an existing ``id`` or ``name`` are updated, the others
+    created. All of them are validated by a pool of ``workers`` threads
+    first. The valid ones are then written in transactions of
+    ``chunk_size`` datasets, and indexed in batches with a single Solr
+    commit once all are written.
+
+    Datasets of the types the gosh plugin handles are written as the pool
+    validated them. Types of other IDatasetForm plugins are validated again
+    by package_create/update.
+
+    :param datasets: the dataset dicts, as for package_create/update
+    :type datasets: list of dictionaries
+    :param chunk_size: datasets written per transaction (default: 100)
+    :type chunk_size: int
+    :param workers: validation threads, up to 16 (default: 4)
+    :type workers: int
+
+    :returns: one result per dataset, in input order, with its ``action``
+        ("create" or "update"), ``id`` and ``success``, and ``errors`` if
+        it failed
+    :rtype: list of dictionaries
+    '''
+    model = context['model']
+
+    datasets = data_dict.get('datasets')
+    if not isinstance(datasets, list):
+        raise ValidationError({'datasets': [_('Must be a list of datasets')]})
+    try:
+        chunk_size = max(1, int(data_dict.get('chunk_size', 100)))
+    except (TypeError, ValueError):
+        raise ValidationError({'chunk_size': [_('Must be an integer')]})
+    try:
+        workers = min(bulk.MAX_WORKERS,
+                      max(1, int(data_dict.get('workers', 4))))
+    except (TypeError, ValueError):
+        raise ValidationError({'workers': [_('Must be an integer')]})
+
+    # Find existing datasets with one query
+    keys = set()
+    for dataset in datasets:
+        keys.update(dataset.get(key) for key in ('id', 'name')
+                    if dataset.get(key))
+    existing = {}
+    if keys:
+        for id, name, type in model.Session.query(
+                model.Package.id, model.Package.name, model.Package.type) \
+                .filter(_or_(model.Package.id.in_(keys),
+                             model.Package.name.in_(keys))):
+            existing[id] = existing[name] = (id, type)
+
+    results = []
+    records = []
+    for dataset in datasets:
+        dataset = dict(dataset)
+        match = existing.get(dataset.get('id')) or \
+            existing.get(dataset.get('name'))
+        if match:
+            action = 'package_update'
+            dataset['id'], dataset['type'] = match
+        else:
+            action = 'package_create'
+        result = {'action': action.split('_')[1], 'id': dataset.get('id'),
+                  'name': dataset.get('name'), 'success': False}
+        try:
+            _check_access(action, dict(context), dataset)
+        except logic.NotAuthorized as e:
+            result['errors'] = {'__all__': [unicode(e) or
+                                            _('Not authorized')]}
+        results.append(result)
+        records.append((action, dataset))
+
+    pending = [i for i, result in enumerate(results)
+               if 'errors' not in result]
+    validated = bulk.validate_many(context, [records[i] for i in pending],
+                                   workers)
+    valid = []
+    for i, (data, errors) in zip(pending, validated):
+        if errors:
+            results[i]['errors'] = errors
+        else:
+            valid.append(i)
+            records[i] += (data,)
+
+    indexed_ids = set()
+    with bulk.deferred_indexing() as changed_ids:
+        for start in range(0, len(valid), chunk_size):
+            chunk = valid[start:start + chunk_size]
+            changed_ids.clear()
+            try:
+                for i in chunk:
+                    _bulk_write(context, records[i], results[i], True)
+                model.repo.commit()
+            except Exception:
+                # Redo the chunk one dataset per transaction, so only the
+                # failing ones are reported
+                model.Session.rollback()
+                changed_ids.clear()
+                for i in chunk:
+                    try:
+                        _bulk_write(context, records[i], results[i], False)
+                    except Exception as e:
+                        model.Session.rollback()
+                        results[i]['id'] = records[i][1].get('id')
+                        results[i]['success'] = False
+                        results[i]['errors'] = getattr(e, 'error_dict',
+                                                       None) or \
+                            {'__all__': [unicode(e)]}
+            indexed_ids.update(changed_ids)
+
+    bulk.index_packages(indexed_ids)
+
+    return results
+
+
+def _bulk_write(context, record, result, defer_commit):
+    action, data_dict, data = record
+    write_context = {'model': context['model'],
+                     'session': context['session'],
+                     'user': context.get('user'),
+                     'defer_commit': defer_commit,
+                     'return_id_only': True,
+                     # Saving adds ids to the dict, so a retry gets a copy
+                     'gosh_validated': copy.deepcopy(data)}
+    result['id'] = logic.get_action(action)(write_context, dict(data_dict))
+    result['success'] = True
+    result.pop('errors', None)
+
+
+@logic.side_effect_free
+def gosh_metrics(context, data_dict):
+    '''Timings and SQL query counts recorded by this worker process, and
+    the hit rates of the gosh caches. Sysadmins only.
+
+    Histograms are keyed by metric name and stage, see
+    ``ckanext.gosh.metrics``.
+    '''
+    _check_access('gosh_metrics', context, data_dict)
+
+    return {
+        'enabled': metrics.enabled,
+        'histograms': metrics.snapshot(),
+        'caches': {
+            'search': search_cache.stats(),
+            'package_version': gosh_helpers.version_cache.stats(),
+            'auth_scope': gosh_scope.scope_cache.stats(),
+            'user_list': gosh_users.user_list_cache.stats(),
+        },
+        'replica': replica.stats(),
+    }
@@ -0,0 +1,194 @@
+import time
+import logging
+import threading
+from bisect import bisect_left, insort
+
+import ckan.model as model
+
+from ckanext.gosh import restricted
+
+log = logging.getLogger(__name__)
+
+
+class AutocompleteIndex(object):
+    '''In-process prefix index over dataset names and titles.
+
+    Lowercased names and titles are kept in two sorted arrays of
+    ``(key, package_id)`` tuples, so a prefix lookup is a bisect plus a
+    short scan. Every entry carries the dataset's private and restricted
+    flags.
+
+    The plugin's package hooks update the index of the worker that made
+    the change. Other workers pick changes up by re-reading the datasets
+    modified since their last look, at most every ``refresh_interval``
+    seconds.
+    '''
+
+    refresh_interval = 30
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._packages = {}
+        self._names = []
+        self._titles = []
+        self._watermark = None
+        self._checked = 0
+        self._building = False
+        self.ready = False
+
+    # Loading
+
+    def build(self):
+        '''Loads every active dataset. Safe to run in a background thread.'''
+        start = time.time()
+        rows = _package_rows().all()
+
+        packages = {}
+        for row in rows:
+            packages[row.id] = (row.name, row.title or u'', row.private,
+                                bool(row.restricted))
+        names = sorted((name.lower(), id)
+                       for id, (name, _, _, _) in packages.items())
+        titles = sorted((title.lower(), id)
+                        for id, (_, title, _, _) in packages.items() if title)
+
+        with self._lock:
+            self._packages = packages
+            self._names = names
+            self._titles = titles
+            self._watermark = max([row.metadata_modified for row in rows]
+                                  or [None])
+            self._checked = time.time()
+            self._building = False
+            self.ready = True
+        log.info('Built the autocomplete index of %s datasets in %.2fs',
+                 len(packages), time.time() - start)
+
+    def build_in_background(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+
+        def run():
+            try:
+                self.build()
+            except Exception:
+                log.exception('Could not build the autocomplete index')
+                with self._lock:
+                    self._building = False
+            finally:
+                model.Session.remove()
+
+        thread = threading.Thread(target=run, name='gosh-autocomplete')
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self):
+        '''Applies the datasets changed since the last build or refresh.'''
+        with self._lock:
+            watermark = self._watermark
+            self._checked = time.time()
+        query = _package_rows(active_only=False)
+        if watermark is not None:
+            query = query.filter(model.Package.metadata_modified >= watermark)
+        for row in query:
+            self.update(row.id, row.name, row.title, row.private,
+                        bool(row.restricted), row.state == 'active')
+            if watermark is None or row.metadata_modified > watermark:
+                watermark = row.metadata_modified
+        with self._lock:
+            self._watermark = watermark
+
+    def ensure_ready(self):
+        '''Returns True if the index can answer queries.
+
+        A cold index starts building in the background, and callers should
+        fall back to SQL meanwhile.
+        '''
+        if not self.ready:
+            self.build_in_background()
+            return False
+        if time.time() - self._checked > self.refresh_interval:
+            self.refresh()
+        return True
+
+    # Updates
+
+    def update(self, id, name, title, private, restricted, active=True):
+        with self._lock:
+            self._discard(id)
+            if not active:
+                return
+            title = title or u''
+            self._packages[id] = (name, title, private, restricted)
+            insort(self._names, (name.lower(), id))
+            if title:
+                insort(self._titles, (title.lower(), id))
+
+    def update_package(self, package):
+        self.update(package.id, package.name, package.title, package.private,
+                    restricted.is_restricted_value(
+                        package.extras.get(restricted.KEY)),
+                    package.state == 'active')
+
+    def remove(self, id):
+        with self._lock:
+            self._discard(id)
+
+    def _discard(self, id):
+        entry = self._packages.pop(id, None)
+        if entry is None:
+            return
+        name, title = entry[0], entry[1]
+        _remove_sorted(self._names, (name.lower(), id))
+        if title:
+            _remove_sorted(self._titles, (title.lower(), id))
+
+    # Queries
+
+    def search(self, q, limit=10, include_restricted=False):
+        '''Returns up to ``limit`` (name, title) pairs matching prefix ``q``.
+
+        Name matches come first in name order, then title matches in title
+        order. Private datasets are never returned.
+        '''
+        q = q.lower()
+        results = []
+        seen = set()
+        with self._lock:
+            for keys in (self._names, self._titles):
+                i = bisect_left(keys, (q,))
+                while i < len(keys) and len(results) < limit:
+                    key, id = keys[i]
+                    if not key.startswith(q):
+                        break
+                    i += 1
+                    if id in seen:
+                        continue
+                    seen.add(id)
+                    name, title, private, restricted = self._packages[id]
+                    if private or (restricted and not include_restricted):
+                        continue
+                    results.append((name, title))
+        return results
+
+
+def _remove_sorted(keys, item):
+    i = bisect_left(keys, item)
+    if i < len(keys) and keys[i] == item:
+        del keys[i]
+
+
+def _package_rows(active_only=True):
+    query = model.Session.query(
+        model.Package.id, model.Package.name, model.Package.title,
+        model.Package.private, model.Package.state,
+        model.Package.metadata_modified,
+        restricted.sql_clause(model.Package.id).label('restricted'))
+    if active_only:
+        query = query.filter(model.Package.state == 'active')
+    return query
+
+
+index = AutocompleteIndex()
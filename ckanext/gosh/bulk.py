@@ -0,0 +1,128 @@
+import logging
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+import pylons
+
+import ckan.lib.plugins as lib_plugins
+import ckan.lib.search as search
+import ckan.model as model
+
+from ckanext.gosh.search_cache import search_cache
+
+log = logging.getLogger(__name__)
+
+# Upper bound of the validation threads a caller can ask for
+MAX_WORKERS = 16
+
+_local = threading.local()
+
+
+@contextmanager
+def deferred_indexing():
+    '''Collects the ids of datasets changed by this thread's commits instead
+    of indexing (and committing Solr) once per dataset.
+
+    The caller indexes the collected ids itself, see ``index_packages``.
+    Other threads keep indexing as usual.
+    '''
+    _local.package_ids = set()
+    try:
+        yield _local.package_ids
+    finally:
+        del _local.package_ids
+
+
+def index_packages(package_ids, batch_size=250):
+    '''Indexes datasets in batches with a single Solr commit at the end.'''
+    package_ids = list(package_ids)
+    for start in range(0, len(package_ids), batch_size):
+        search.rebuild(package_ids=package_ids[start:start + batch_size],
+                       defer_commit=True, quiet=True)
+    if package_ids:
+        search.commit()
+        # Searches cached since the database commit may predate the index
+        search_cache.invalidate()
+
+
+def _install():
+    # Core indexes datasets from an IDomainObjectModification observer on
+    # every commit. Wrap it so threads inside deferred_indexing skip it.
+    plugin_class = search.SynchronousSearchPlugin
+    if getattr(plugin_class.notify, 'gosh_deferrable', False):
+        return
+    original = plugin_class.notify
+
+    def notify(self, entity, operation):
+        package_ids = getattr(_local, 'package_ids', None)
+        if package_ids is not None and isinstance(entity, model.Package) \
+                and operation != \
+                model.domain_object.DomainObjectOperation.deleted:
+            package_ids.add(entity.id)
+            return
+        return original(self, entity, operation)
+
+    notify.gosh_deferrable = True
+    plugin_class.notify = notify
+
+
+_install()
+
+
+class _Untranslated(object):
+    '''Stands in for the translator where none is registered, as
+    ``ckan.lib.cli.MockTranslator`` does for paster commands.'''
+
+    def gettext(self, value):
+        return value
+
+    ugettext = gettext
+
+    def ungettext(self, singular, plural, n):
+        return plural if n > 1 else singular
+
+
+def _current_translator():
+    try:
+        return pylons.translator._current_obj()
+    except TypeError:
+        # Not in a request
+        return _Untranslated()
+
+
+def validate_many(context, records, workers=4):
+    '''Validates ``(action, data_dict)`` records with a pool of threads.
+
+    Returns ``(data, errors)`` pairs in input order. Each thread works with
+    its own scoped database session, and with the caller's translator
+    registered, which the validators' error messages need.
+    '''
+    translator = _current_translator()
+
+    def validate(record):
+        action, data_dict = record
+        pylons.translator._push_object(translator)
+        try:
+            package_plugin = lib_plugins.lookup_package_plugin(
+                data_dict.get('type'))
+            if action == 'package_update':
+                schema = package_plugin.update_package_schema()
+            else:
+                schema = package_plugin.create_package_schema()
+            return lib_plugins.plugin_validate(
+                package_plugin, dict(context), dict(data_dict), schema,
+                action)
+        except Exception as e:
+            log.exception('Could not validate dataset')
+            return None, {'__all__': [unicode(e)]}
+        finally:
+            model.Session.remove()
+            pylons.translator._pop_object(translator)
+
+    pool = ThreadPool(min(MAX_WORKERS, max(1, workers)))
+    try:
+        return pool.map(validate, records)
+    finally:
+        pool.close()
+        pool.join()
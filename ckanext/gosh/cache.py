@@ -0,0 +1,60 @@
+import time
+import threading
+from collections import OrderedDict
+
+_missing = object()
+
+
+class LRUCache(object):
+    '''Small thread-safe LRU cache with an optional per-entry TTL.
+
+    Entries older than ``ttl`` seconds are treated as missing. A ``ttl`` of
+    ``None`` keeps entries until they are evicted or invalidated. Hits and
+    misses are counted so they can be reported.
+    '''
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _missing)
+            if entry is not _missing:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    self._data[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _missing)
+        return default if entry is _missing else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize}
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,169 @@
+import sys
+import logging
+
+from ckan.lib.cli import CkanCommand
+
+log = logging.getLogger(__name__)
+
+
+class GoshCommand(CkanCommand):
+    '''Maintenance commands for the gosh portal
+
+    Usage:
+
+      gosh initdb
+        - Creates the plugin's tables
+
+      gosh backfill-versions
+        - Recomputes the version number of every dataset from its
+          revision history
+
+      gosh create-indexes [<group> ...]
+        - Creates optional database indexes. Groups are "prefix" and
+          "trigram" (for ckanext.gosh.autocomplete_index) and
+          "resource-extras" (for resource_search on resource extras).
+          Without arguments the autocomplete group enabled in the config
+          is created
+
+      gosh migrate-restricted [--batch-size=<n>]
+        - Normalizes the restricted flag of every dataset to "1" or "0",
+          creates its partial index and reindexes the datasets having it
+          in batches, so ckanext.gosh.restricted_typed can be enabled
+
+      gosh export [--format=jsonl|csv] [--output=<file>] [--user=<name>]
+                  [--include-private] [--batch-size=<n>]
+        - Writes every dataset the user (anonymous by default) may see to
+          the file, or to stdout, reading the index page by page
+
+    The commands should be run from the ckanext-gosh directory and expect
+    a development.ini file to be present. Most of the time you will
+    specify the config explicitly though::
+
+        paster gosh backfill-versions --config=../ckan/development.ini
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 9
+    min_args = 1
+
+    def __init__(self, name):
+        super(GoshCommand, self).__init__(name)
+        self.parser.add_option('--batch-size', dest='batch_size',
+                               type='int', default=250,
+                               help='Datasets reindexed per Solr commit, or '
+                                    'exported per Solr page')
+        self.parser.add_option('--format', dest='format', default='jsonl',
+                               help='Export format, jsonl or csv')
+        self.parser.add_option('--output', dest='output',
+                               help='Export file, defaults to stdout')
+        self.parser.add_option('--user', dest='user', default='',
+                               help='Export what this user may see')
+        self.parser.add_option('--include-private', dest='include_private',
+                               action='store_true', default=False,
+                               help='Export private datasets the user may '
+                                    'see (always on with the gosh plugin, '
+                                    'as in package_search)')
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'initdb':
+            self.initdb()
+        elif cmd == 'backfill-versions':
+            self.backfill_versions()
+        elif cmd == 'create-indexes':
+            self.create_indexes()
+        elif cmd == 'migrate-restricted':
+            self.migrate_restricted()
+        elif cmd == 'export':
+            self.export()
+        else:
+            print('Command %s not recognized' % cmd)
+            sys.exit(1)
+
+    def initdb(self):
+        import ckanext.gosh.model as gosh_model
+
+        gosh_model.setup()
+        if not gosh_model.package_version_table.exists(
+                bind=gosh_model.meta.engine):
+            print('Run `paster db init` first')
+            sys.exit(1)
+        print('The gosh tables are in place')
+
+    def backfill_versions(self):
+        import ckanext.gosh.model as gosh_model
+
+        gosh_model.setup()
+        count = gosh_model.backfill_package_versions()
+        print('Stored the version of {0} datasets'.format(count))
+
+    def create_indexes(self):
+        from ckan.common import config
+        import ckanext.gosh.model as gosh_model
+
+        groups = self.args[1:]
+        if not groups:
+            mode = config.get('ckanext.gosh.autocomplete_index')
+            if mode in gosh_model.INDEXES:
+                groups.append(mode)
+        if not groups:
+            print('No index groups given or enabled in the config')
+            return
+
+        try:
+            created = gosh_model.create_indexes(groups)
+        except ValueError as e:
+            print(str(e))
+            sys.exit(1)
+        for name in created:
+            print('Created index {0}'.format(name))
+        print('Indexes for {0} are in place'.format(', '.join(groups)))
+
+    def migrate_restricted(self):
+        import ckanext.gosh.model as gosh_model
+        from ckanext.gosh import bulk, restricted
+
+        ids = restricted.migrate()
+        gosh_model.create_indexes(['restricted'])
+
+        batch_size = self.options.batch_size
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            bulk.index_packages(batch, batch_size)
+            print('Reindexed {0}/{1} datasets'.format(
+                start + len(batch), len(ids)))
+        print('Done. Set ckanext.gosh.restricted_typed = true to filter on '
+              'the {0} field'.format(restricted.SOLR_FIELD))
+
+    def export(self):
+        import ckan.logic as logic
+        import ckan.model as model
+        from ckanext.gosh.actions import catalogue_export
+
+        context = {'model': model, 'session': model.Session,
+                   'user': self.options.user}
+        try:
+            lines = catalogue_export(context, {
+                'format': self.options.format,
+                'include_private': self.options.include_private,
+                'batch_size': self.options.batch_size})
+        except logic.ValidationError as e:
+            print(e.error_summary)
+            sys.exit(1)
+
+        out = open(self.options.output, 'wb') if self.options.output \
+            else sys.stdout
+        count = 0
+        try:
+            for line in lines:
+                out.write(line)
+                count += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        if self.options.output:
+            print('Wrote {0} lines to {1}'.format(count,
+                                                  self.options.output))
@@ -0,0 +1,56 @@
+import ckan.lib.base as base
+import ckan.logic as logic
+import ckan.model as model
+from ckan.common import _, c, request, response
+
+from ckanext.gosh.metrics import metrics
+
+
+class MetricsController(base.BaseController):
+
+    def prometheus(self):
+        '''The gosh_metrics histograms in the Prometheus text format.
+
+        Sysadmins only, scrapers authenticate with an API key in the
+        Authorization header.
+        '''
+        context = {'model': model, 'user': c.user, 'auth_user_obj': c.userobj}
+        try:
+            logic.check_access('gosh_metrics', context, {})
+        except logic.NotAuthorized:
+            base.abort(403, _('Not authorized to see this page'))
+
+        response.headers['Content-Type'] = \
+            'text/plain; version=0.0.4; charset=utf-8'
+        return metrics.prometheus()
+
+
+class ExportController(base.BaseController):
+
+    def export(self, format):
+        '''Streams the datasets the user may see, see
+        ``actions.catalogue_export``.
+
+        Takes q, fq, include_private, include_drafts and fields as query
+        parameters.
+        '''
+        from ckanext.gosh.actions import catalogue_export
+
+        context = {'model': model, 'session': model.Session, 'user': c.user,
+                   'auth_user_obj': c.userobj}
+        data_dict = dict((key, request.params[key])
+                         for key in ('q', 'fq', 'include_private',
+                                     'include_drafts', 'fields')
+                         if key in request.params)
+        data_dict['format'] = format
+        try:
+            lines = catalogue_export(context, data_dict)
+        except logic.NotAuthorized:
+            base.abort(403, _('Not authorized to see this page'))
+
+        response.headers['Content-Type'] = (
+            'text/csv; charset=utf-8' if format == 'csv'
+            else 'application/x-ndjson; charset=utf-8')
+        response.headers['Content-Disposition'] = \
+            'attachment; filename="catalogue.{0}"'.format(format)
+        return lines
@@ -0,0 +1,215 @@
+'''Streams the catalogue, or the datasets matching a search, as JSON Lines
+or CSV, and pages package_search results with cursorMark.
+
+Datasets are read from Solr a page at a time with cursorMark paging, which
+costs the same for every page, unlike growing ``start`` offsets. Only one
+page is held in memory, and lines, encoded as UTF-8, are produced as they
+are read.
+'''
+import csv
+import logging
+
+import pysolr
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import ckan.lib.search.common as search_common
+from ckan.lib.search.common import SearchError, SearchQueryError
+from ckan.lib.search.query import (QUERY_FIELDS, VALID_SOLR_PARAMETERS,
+                                   solr_literal)
+from ckan.common import config
+
+from ckanext.gosh import restricted
+
+log = logging.getLogger(__name__)
+
+FORMATS = ('jsonl', 'csv')
+
+# What cursor_search passes on to Solr, as PackageSearchQuery.run allows
+CURSOR_PARAMETERS = VALID_SOLR_PARAMETERS | set(['cursorMark'])
+
+# Stored Solr fields exported to CSV by default, extras are exported with
+# their ``extras_`` prefix
+CSV_FIELDS = ('id', 'name', 'title', 'notes', 'organization', 'groups',
+              'tags', 'res_format', 'license_id', 'metadata_created',
+              'metadata_modified', 'extras_restricted', 'extras_language')
+
+
+def filter_queries(fq, scope, include_private=False, include_drafts=False):
+    '''The filter queries package_search applies for ``scope``, with the
+    ones ``PackageSearchQuery.run`` adds.
+
+    ``fq``, ``include_private`` and ``include_drafts`` are taken as they
+    are: running the ``before_search`` hooks on them first, as
+    package_search does, is up to the caller (see
+    ``actions.catalogue_export``).
+    '''
+    from ckanext.gosh.actions import _permission_fq
+
+    fq = _permission_fq(fq or '', scope, include_private, include_drafts)
+    if restricted.hidden_for(scope.user):
+        fq = fq + ' ' + restricted.solr_fq()
+    fq_list = [fq,
+               '+site_id:{0}'.format(solr_literal(config.get('ckan.site_id')))]
+    if '+state:' not in fq:
+        fq_list.append('+state:active')
+    return fq_list
+
+
+def iter_documents(fq_list, fl, q=None, batch_size=250):
+    '''Yields the stored fields ``fl`` of every matching dataset, in id
+    order.'''
+    params = {'fq': fq_list, 'fl': fl, 'sort': 'id asc', 'rows': batch_size}
+    if not q:
+        q = '*:*'
+    elif ':' not in q:
+        # Free text, matched like package_search does
+        params.update(defType='dismax', tie='0.1', mm='2<-1 5<80%',
+                      qf=QUERY_FIELDS)
+
+    conn = search_common.make_connection(decode_dates=False)
+    cursor_mark = '*'
+    while True:
+        results = conn.search(q, cursorMark=cursor_mark, **params)
+        for doc in results.docs:
+            yield doc
+        next_cursor_mark = results.nextCursorMark
+        if not results.docs or next_cursor_mark in (None, cursor_mark):
+            break
+        cursor_mark = next_cursor_mark
+
+
+def cursor_sort(sort):
+    '''Adds the unique ``id`` tiebreaker Solr needs for cursorMark to a
+    sort.'''
+    fields = [clause.split()[0] for clause in sort.split(',')
+              if clause.strip()]
+    if 'id' in fields:
+        return sort
+    return (sort + ', ' if fields else '') + 'id asc'
+
+
+def cursor_search(query, cursor_mark):
+    '''Runs a package_search query for the page after ``cursor_mark``.
+
+    Does what ``PackageSearchQuery.run`` does, which can't pass cursorMark
+    to Solr nor return the next one, except that no extra row is fetched
+    (it would be skipped by the next page) and ``start`` is not allowed.
+    ``query['sort']`` must end in a unique field, see ``cursor_sort``.
+    Parameters run() would reject raise SearchQueryError, as there.
+
+    Returns the count, results, facets and the next cursor mark, which is
+    ``cursor_mark`` again when there are no more results.
+    '''
+    invalid = set(query) - CURSOR_PARAMETERS
+    if invalid:
+        raise SearchQueryError('Invalid search parameters: %s'
+                               % sorted(invalid))
+    query = dict(query)
+    query.pop('start', None)
+    if query.get('q') in (None, '', '""', "''"):
+        query['q'] = '*:*'
+    query['rows'] = min(1000, int(query.get('rows', 10)))
+
+    fq = [query['fq']] if query.get('fq') else []
+    fq.extend(query.pop('fq_list', []))
+    fq.append('+site_id:{0}'.format(solr_literal(config.get('ckan.site_id'))))
+    if '+state:' not in query.get('fq', ''):
+        fq.append('+state:active')
+    query['fq'] = fq
+
+    query['facet'] = query.get('facet', 'true')
+    query['facet.limit'] = query.get('facet.limit',
+                                     config.get('search.facets.limit', '50'))
+    query['facet.mincount'] = query.get('facet.mincount', 1)
+    query['fl'] = query.get('fl', 'name')
+    query['wt'] = query.get('wt', 'json')
+    defType = query.get('defType', 'dismax')
+    if ':' not in query['q'] or defType == 'edismax':
+        query['defType'] = defType
+        query['tie'] = query.get('tie', '0.1')
+        query['mm'] = query.get('mm', '2<-1 5<80%')
+        query['qf'] = query.get('qf', QUERY_FIELDS)
+    query['cursorMark'] = cursor_mark
+
+    conn = search_common.make_connection(decode_dates=False)
+    try:
+        response = conn.search(**query)
+    except pysolr.SolrError as e:
+        raise SearchError('SOLR returned an error running query: %r Error: %r'
+                          % (query, e))
+
+    results = response.docs
+    for result in results:
+        extra_keys = [key for key in result if key.startswith('extras_')]
+        if extra_keys:
+            result['extras'] = dict((key[len('extras_'):], result.pop(key))
+                                    for key in extra_keys)
+    if query['fl'] in ('id', 'name'):
+        results = [result.get(query['fl']) for result in results]
+
+    facets = response.facets.get('facet_fields', {})
+    for field, values in facets.items():
+        facets[field] = dict(zip(values[0::2], values[1::2]))
+
+    return (response.hits, results, facets,
+            response.nextCursorMark or cursor_mark)
+
+
+def jsonl_lines(docs, data_source='validated_data_dict'):
+    '''One line per dataset, the dataset dict as stored in the index.'''
+    for doc in docs:
+        package_json = doc.get(data_source)
+        if package_json:
+            # Stored as written by json.dumps, so it is a single line
+            if isinstance(package_json, unicode):
+                package_json = package_json.encode('utf-8')
+            yield package_json + '\n'
+        else:
+            log.error('No package_dict is coming from solr for package id %s',
+                      doc.get('id'))
+
+
+def csv_lines(docs, fields=CSV_FIELDS):
+    '''A header line, then one line per dataset. Multi-valued fields are
+    joined with ";".'''
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        writer.writerow([_csv_value(value) for value in values])
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    yield line(fields)
+    for doc in docs:
+        yield line([doc.get(field) for field in fields])
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        value = u';'.join(unicode(item) for item in value)
+    elif not isinstance(value, basestring):
+        value = unicode(value)
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def export_lines(scope, format='jsonl', q=None, fq=None,
+                 include_private=False, include_drafts=False,
+                 fields=None, batch_size=250):
+    '''Lines of the export of what ``scope`` may see, see
+    ``actions.catalogue_export``.'''
+    fq_list = filter_queries(fq, scope, include_private, include_drafts)
+    if format == 'csv':
+        fields = fields or CSV_FIELDS
+        return csv_lines(iter_documents(fq_list, ' '.join(fields), q,
+                                        batch_size), fields)
+    return jsonl_lines(iter_documents(fq_list, 'id validated_data_dict', q,
+                                      batch_size))
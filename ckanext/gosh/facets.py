@@ -0,0 +1,122 @@
+import time
+import logging
+import threading
+
+from sqlalchemy import event
+
+import ckan.model as model
+
+from ckanext.gosh import helpers as gosh_helpers
+from ckanext.gosh.metrics import metrics
+from ckanext.gosh.replica import replica
+from ckanext.gosh.search_cache import search_cache
+
+log = logging.getLogger(__name__)
+
+GROUP_FACETS = ('groups', 'organization')
+
+
+class GroupTitles(object):
+    '''Titles of all groups and organizations, by name.
+
+    Loaded with one query and kept for ``ttl`` seconds. Group changes made
+    in this worker drop the map right away. Names missing from the map
+    (e.g. groups created by another worker) are looked up once and added.
+    '''
+
+    ttl = 300
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._titles = None
+        self._loaded = 0
+
+    def get_many(self, names):
+        titles = self._titles
+        if titles is None or time.time() - self._loaded > self.ttl:
+            titles = self._load()
+        missing = [name for name in names if name not in titles]
+        if missing:
+            found = replica.run(lambda session: dict(
+                session.query(model.Group.name, model.Group.title)
+                .filter(model.Group.name.in_(missing))))
+            with self._lock:
+                for name in missing:
+                    titles[name] = found.get(name)
+        return titles
+
+    def _load(self):
+        titles = replica.run(lambda session: dict(
+            session.query(model.Group.name, model.Group.title)))
+        with self._lock:
+            self._titles = titles
+            self._loaded = time.time()
+        return titles
+
+    def invalidate(self):
+        with self._lock:
+            self._titles = None
+
+
+group_titles = GroupTitles()
+
+_license_titles = {}
+
+
+def license_titles():
+    '''License titles by id, in the current locale. The license register
+    does not change while CKAN runs, so the map is built once per locale.'''
+    locale = gosh_helpers._current_locale()
+    titles = _license_titles.get(locale)
+    if titles is None:
+        titles = dict(
+            (id, license.title)
+            for id, license in model.Package.get_license_register().items())
+        # Outside a request there is no locale to keep the titles under
+        if locale is not None:
+            _license_titles[locale] = titles
+    return titles
+
+
+def restructure(facets):
+    '''Turns Solr's facet counts into package_search's ``search_facets``.
+
+    Display names come from the in-memory title maps, and each facet's items
+    are built sorted by display name, in descending order.
+    '''
+    titles = {}
+    if any(facets.get(field) for field in GROUP_FACETS):
+        with metrics.span('group_titles'):
+            titles = group_titles.get_many(
+                [name for field in GROUP_FACETS
+                 for name in facets.get(field, {})])
+    licenses = license_titles() if facets.get('license_id') else {}
+
+    restructured_facets = {}
+    for key, value in facets.items():
+        items = []
+        for name, count in value.items():
+            if key in GROUP_FACETS:
+                display_name = titles.get(name)
+                if not (display_name and display_name.strip()):
+                    display_name = name
+            elif key == 'license_id':
+                display_name = licenses[name] if name in licenses else name
+            else:
+                display_name = name
+            items.append({'name': name,
+                          'display_name': display_name,
+                          'count': count})
+        items.sort(key=lambda item: item['display_name'], reverse=True)
+        restructured_facets[key] = {'title': key, 'items': items}
+    return restructured_facets
+
+
+def _invalidate(mapper, connection, target):
+    group_titles.invalidate()
+    # Cached search results carry the old display names
+    search_cache.invalidate()
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(model.Group, _event, _invalidate)
@@ -1,60 +1,213 @@
 import os
 import json
+import time
 import logging
+import functools
+import threading
 
-import ckan.logic as l
+from ckan.common import _
+import ckan.plugins.toolkit as toolkit
+
+import ckanext.gosh.model as gosh_model
+from ckanext.gosh import users as gosh_users
+from ckanext.gosh.cache import LRUCache
+from ckanext.gosh.metrics import metrics
 
 log = logging.getLogger(__name__)
 
 get_languages_path = lambda: os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                                       'language-codes.json')
-def language_options():
-    '''ISO-639-1 Languages''' 
-    
-    languages = []
-    try:
-        with open(get_languages_path()) as f:
+
+
+class LanguageRegistry(object):
+    '''Process-wide registry of the ISO-639-1 languages.
+
+    The languages file is parsed once and indexed by code. The file is
+    re-read only when its mtime changes, and the mtime itself is checked at
+    most once every ``check_interval`` seconds. Translated copies are built
+    once per UI locale and kept in the file's order.
+    '''
+
+    check_interval = 10
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0
+        self._languages = []
+        self._by_locale = {}
+
+    def _refresh(self):
+        now = time.time()
+        if self._mtime is not None and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            log.error(str(e))
+            return
+        if mtime == self._mtime:
+            return
+
+        with self._lock:
+            if mtime == self._mtime:
+                return
             try:
-                languages = json.loads(f.read())
-                log.info('Successfully loaded {} languages'.format(len(languages)))
-                
-            except ValueError as e:
+                with open(self.path) as f:
+                    languages = json.loads(f.read())
+            except (IOError, ValueError) as e:
                 log.error(str(e))
-                
-    except IOError as e:
-        log.error(str(e))
-            
-    return languages
+                return
+            self._languages = languages
+            self._by_locale = {}
+            self._mtime = mtime
+            log.info('Successfully loaded {} languages'.format(len(languages)))
 
-def get_language_by_code(code):
-    
-    language = None
+    def _for_locale(self, locale):
+        self._refresh()
+        entry = self._by_locale.get(locale)
+        if entry is None:
+            languages = []
+            for lang in self._languages:
+                lang = dict(lang)
+                if locale and lang.get('language'):
+                    lang['language'] = _(lang['language'])
+                languages.append(lang)
+            by_code = dict((lang.get('code'), lang) for lang in languages)
+            entry = self._by_locale[locale] = (languages, by_code)
+        return entry
+
+    def languages(self, locale=None):
+        return self._for_locale(locale)[0]
+
+    def get(self, code, locale=None):
+        return self._for_locale(locale)[1].get(code)
+
+    def clear(self):
+        with self._lock:
+            self._mtime = None
+            self._languages = []
+            self._by_locale = {}
+
+
+language_registry = LanguageRegistry(get_languages_path())
+
+
+# Request environ key holding the helper results memoized in this request
+_MEMO_KEY = 'ckanext.gosh.helper_memo'
+
+
+def memoize_per_request(function):
+    '''Remembers a helper's results for the rest of the request, so a
+    template calling it repeatedly with the same arguments runs it once.'''
+    @functools.wraps(function)
+    def wrapper(*args):
+        try:
+            memo = toolkit.request.environ.setdefault(_MEMO_KEY, {})
+        except (TypeError, AttributeError):
+            # Outside of a web request
+            return function(*args)
+        key = (function.__name__,) + args
+        try:
+            return memo[key]
+        except KeyError:
+            value = memo[key] = function(*args)
+            return value
+    return wrapper
+
+
+def _current_locale():
     try:
-        with open(get_languages_path()) as f:
-            try:
-                languages = json.loads(f.read())
-                for lang in languages:
-                    
-                    if lang.get('code') != code:
-                        continue
-                    
-                    language = lang
-                
-            except ValueError as e:
-                log.error(str(e))
-                
-    except IOError as e:
-        log.error(str(e))
-            
-    return language
+        from ckan.lib.i18n import get_lang
+        return get_lang()
+    except Exception:
+        # Not inside a request, so there is nothing to translate to
+        return None
 
+
+@metrics.timed('h.language_options')
+def language_options():
+    '''ISO-639-1 Languages'''
+
+    return language_registry.languages(_current_locale())
+
+
+@metrics.timed('h.get_language_by_code')
+@memoize_per_request
+def get_language_by_code(code):
+
+    return language_registry.get(code, _current_locale())
+
+
+# Version numbers by package id. Writes in this process invalidate their
+# entry, the TTL bounds how stale other workers can be.
+version_cache = LRUCache(maxsize=5000, ttl=300)
+
+
+@metrics.timed('h.get_package_version')
+@memoize_per_request
 def get_package_version(id):
-    version = 1
+    version = version_cache.get(id)
+    if version is None:
+        version = gosh_model.get_package_version(id)
+        if version is None:
+            # Not backfilled yet, count it once with a single query
+            version = max(gosh_model.count_package_revisions(id), 1)
+        version_cache.set(id, version)
+
+    return version
+
+
+@metrics.timed('h.gosh_linked_users')
+def linked_users(users, maxlength=0):
+
+    return gosh_users.linked_users(users, maxlength=maxlength)
+
+
+# Rendered template fragments of each dataset by (name, locale), along with
+# the metadata_modified they were rendered for. Changes in this process drop
+# a dataset's entry, changes made elsewhere update metadata_modified, which
+# replaces it on the next render.
+fragment_cache = LRUCache(maxsize=1000)
+
+
+def _forget_package_version(id):
+    version_cache.pop(id)
     try:
-        _ = l.get_action('package_revision_list')({}, {'id': id})
-        version = len(_)
-        
-    except l.NotFound:
-        pass
-    
-    return version
\ No newline at end of file
+        memo = toolkit.request.environ.get(_MEMO_KEY)
+    except (TypeError, AttributeError):
+        return
+    if memo:
+        memo.pop(('get_package_version', id), None)
+
+
+@metrics.timed('h.gosh_cached_fragment')
+def cached_fragment(name, pkg_dict, caller):
+    '''Renders the body of a ``{% call %}`` block once per dataset version
+    and locale::
+
+        {% call h.gosh_cached_fragment('additional_info', pkg_dict) %}
+          ...
+        {% endcall %}
+
+    The body must only depend on the dataset and the locale.
+    '''
+    package_id = pkg_dict.get('id')
+    modified = pkg_dict.get('metadata_modified')
+    if not (package_id and modified):
+        return caller()
+    key = (name, _current_locale())
+    fragments = fragment_cache.get(package_id)
+    if fragments is None or fragments.get('modified') != modified:
+        fragments = {'modified': modified}
+        fragment_cache.set(package_id, fragments)
+    html = fragments.get(key)
+    if html is None:
+        # The version this worker cached may predate the change that
+        # brought a new metadata_modified, and would stay in the fragment
+        # until the next one
+        _forget_package_version(package_id)
+        html = fragments[key] = caller()
+    return html
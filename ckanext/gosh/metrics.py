@@ -0,0 +1,196 @@
+'''Timings and SQL query counts of the gosh actions, their stages and the
+template helpers.
+
+Enabled with ``ckanext.gosh.metrics = true``. Every span records its
+duration and the number of SQL statements run inside it into histograms,
+and every web request its total duration and statement count. The numbers
+are per worker process, read them with the ``gosh_metrics`` action or
+from ``/gosh/metrics`` in the Prometheus text format.
+'''
+import functools
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# name: (label name, buckets, help)
+METRICS = {
+    'gosh_stage_seconds': (
+        'stage', SECONDS_BUCKETS, 'Time spent in an action, stage or helper'),
+    'gosh_stage_queries': (
+        'stage', QUERY_BUCKETS, 'SQL statements run in an action, stage or '
+        'helper'),
+    'gosh_request_seconds': (
+        'kind', SECONDS_BUCKETS, 'Time to handle a web request'),
+    'gosh_request_queries': (
+        'kind', QUERY_BUCKETS, 'SQL statements run for a web request'),
+}
+
+_local = threading.local()
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        '''``(bound, count)`` pairs, counting all observations up to each
+        bound as Prometheus does.'''
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class _Span(object):
+
+    __slots__ = ('metrics', 'stage', 'start', 'queries')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        if self.metrics.enabled:
+            self.queries = query_count()
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            self.metrics.observe('gosh_stage_seconds', self.stage,
+                                 time.time() - self.start)
+            self.metrics.observe('gosh_stage_queries', self.stage,
+                                 query_count() - self.queries)
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def configure(self, config, engine):
+        from paste.deploy.converters import asbool
+        self.enabled = asbool(config.get('ckanext.gosh.metrics', False))
+        if self.enabled and not event.contains(
+                engine, 'before_cursor_execute', _count_query):
+            event.listen(engine, 'before_cursor_execute', _count_query)
+
+    def span(self, stage):
+        '''Context manager recording the time and queries of ``stage``.'''
+        return _Span(self, stage)
+
+    def timed(self, stage):
+        '''Decorator recording every call of a function as ``stage``.'''
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with _Span(self, stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, name, label, value):
+        key = (name, label)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(METRICS[name][1])
+            histogram.observe(value)
+
+    def snapshot(self):
+        '''All histograms, as ``{name: {label: {count, sum, buckets}}}``.'''
+        with self._lock:
+            items = sorted(self._histograms.items())
+            result = {}
+            for (name, label), histogram in items:
+                result.setdefault(name, {})[label] = {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'buckets': histogram.cumulative(),
+                }
+        return result
+
+    def prometheus(self):
+        '''All histograms in the Prometheus text exposition format.'''
+        lines = []
+        snapshot = self.snapshot()
+        for name in sorted(snapshot):
+            label_name, buckets, help = METRICS[name]
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} histogram'.format(name))
+            for label, histogram in sorted(snapshot[name].items()):
+                label = label.replace('\\', '\\\\').replace('"', '\\"')
+                for bound, count in histogram['buckets']:
+                    lines.append('{0}_bucket{{{1}="{2}",le="{3}"}} {4}'
+                                 .format(name, label_name, label, bound,
+                                         count))
+                lines.append('{0}_bucket{{{1}="{2}",le="+Inf"}} {3}'.format(
+                    name, label_name, label, histogram['count']))
+                lines.append('{0}_sum{{{1}="{2}"}} {3}'.format(
+                    name, label_name, label, histogram['sum']))
+                lines.append('{0}_count{{{1}="{2}"}} {3}'.format(
+                    name, label_name, label, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+
+metrics = Metrics()
+
+
+def _count_query(*args, **kwargs):
+    _local.queries = getattr(_local, 'queries', 0) + 1
+
+
+def query_count():
+    '''SQL statements this thread has run since the query hook was
+    installed.'''
+    return getattr(_local, 'queries', 0)
+
+
+class MetricsMiddleware(object):
+    '''Records the duration and SQL statement count of every request.'''
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if not metrics.enabled:
+            return self.app(environ, start_response)
+        kind = 'api' if environ.get('PATH_INFO', '').startswith('/api/') \
+            else 'page'
+        queries = query_count()
+        start = time.time()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            metrics.observe('gosh_request_seconds', kind, time.time() - start)
+            metrics.observe('gosh_request_queries', kind,
+                            query_count() - queries)
@@ -0,0 +1,158 @@
+import logging
+
+from sqlalchemy import (MetaData, Table, Column, Integer, UnicodeText,
+                        ForeignKey, func, select, text)
+
+import ckan.model as model
+from ckan.model import meta
+
+log = logging.getLogger(__name__)
+
+# The plugin's own tables, kept out of core's metadata so core's
+# create_all/drop_all and `paster db` commands leave them alone
+metadata = MetaData()
+
+# Maintained version number of every dataset, so rendering it does not
+# have to walk the dataset's whole revision history.
+package_version_table = Table(
+    'gosh_package_version', metadata,
+    Column('package_id', UnicodeText,
+           ForeignKey(model.package_table.c.id, ondelete='CASCADE'),
+           primary_key=True),
+    Column('version', Integer, nullable=False, default=1),
+)
+
+# Distinct revisions touching a dataset, the same set package_revision_list
+# returns: the package itself plus its resources, extras and tags.
+_REVISIONS_SQL = '''
+    SELECT id AS package_id, revision_id FROM package_revision
+    UNION ALL SELECT package_id, revision_id FROM resource_revision
+    UNION ALL SELECT package_id, revision_id FROM package_extra_revision
+    UNION ALL SELECT package_id, revision_id FROM package_tag_revision
+'''
+
+# Optional indexes, created with `paster gosh create-indexes <group>`.
+# Postgres 9.2 has no CREATE INDEX IF NOT EXISTS, so existing ones are
+# looked up in pg_indexes first.
+INDEXES = {
+    # package_autocomplete with ckanext.gosh.autocomplete_index = prefix
+    'prefix': [
+        ('idx_gosh_package_name_prefix',
+         'CREATE INDEX {0} ON package (lower(name) text_pattern_ops)'),
+        ('idx_gosh_package_title_prefix',
+         'CREATE INDEX {0} ON package (lower(title) text_pattern_ops)'),
+    ],
+    # package_autocomplete with ckanext.gosh.autocomplete_index = trigram,
+    # also serves the default ILIKE matching
+    'trigram': [
+        (None, 'CREATE EXTENSION IF NOT EXISTS pg_trgm'),
+        ('idx_gosh_package_name_trgm',
+         'CREATE INDEX {0} ON package USING gin (name gin_trgm_ops)'),
+        ('idx_gosh_package_title_trgm',
+         'CREATE INDEX {0} ON package USING gin (title gin_trgm_ops)'),
+    ],
+    # resource_search on resource extras. Extras are a JSON text blob matched
+    # with ILIKE '%"field": "%term%"...', which a trigram index serves
+    # without changing the query or its results.
+    'resource-extras': [
+        (None, 'CREATE EXTENSION IF NOT EXISTS pg_trgm'),
+        ('idx_gosh_resource_extras_trgm',
+         'CREATE INDEX {0} ON resource USING gin (extras gin_trgm_ops)'),
+    ],
+    # The restricted flag as a small partial index, matching the predicate of
+    # restricted.sql_clause so the anti-join is an index lookup
+    'restricted': [
+        ('idx_gosh_package_extra_restricted',
+         "CREATE INDEX {0} ON package_extra (package_id) "
+         "WHERE key = 'restricted' AND value = '1' AND state = 'active'"),
+    ],
+}
+
+
+def setup():
+    '''Creates the plugin's tables if they are missing.
+
+    Does nothing before core's tables exist (e.g. while `paster db init`
+    runs), run `paster gosh initdb` afterwards or let the next start create
+    them.
+    '''
+    if not model.package_table.exists(bind=meta.engine):
+        log.debug('No package table yet, not creating %s',
+                  package_version_table.name)
+        return
+    if not package_version_table.exists(bind=meta.engine):
+        package_version_table.create(bind=meta.engine)
+        log.info('Created table %s', package_version_table.name)
+
+
+def count_package_revisions(package_id):
+    '''Counts the revisions of a dataset with a single query.'''
+    sql = text('SELECT count(DISTINCT revision_id) FROM ({0}) r '
+               'WHERE package_id = :id'.format(_REVISIONS_SQL))
+    return model.Session.execute(sql, {'id': package_id}).scalar() or 0
+
+
+def get_package_version(package_id):
+    '''Returns the stored version of a dataset, or None if it has none.'''
+    table = package_version_table
+    return model.Session.execute(
+        select([table.c.version])
+        .where(table.c.package_id == package_id)).scalar()
+
+
+def bump_package_version(package_id):
+    '''Increments the version of a dataset within the current transaction.
+
+    Datasets without a stored version yet get theirs counted from the
+    revision history instead.
+    '''
+    table = package_version_table
+    result = model.Session.execute(
+        table.update()
+        .where(table.c.package_id == package_id)
+        .values(version=table.c.version + 1))
+    if result.rowcount:
+        return get_package_version(package_id)
+
+    model.Session.flush()
+    version = max(count_package_revisions(package_id), 1)
+    model.Session.execute(
+        table.insert().values(package_id=package_id, version=version))
+    return version
+
+
+def backfill_package_versions():
+    '''Recomputes the version of every dataset from its revision history.'''
+    table = package_version_table
+    model.Session.execute(table.delete())
+    model.Session.execute(text(
+        'INSERT INTO {0} (package_id, version) '
+        'SELECT r.package_id, count(DISTINCT r.revision_id) FROM ({1}) r '
+        'JOIN package p ON p.id = r.package_id '
+        'GROUP BY r.package_id'.format(table.name, _REVISIONS_SQL)))
+    count = model.Session.execute(
+        select([func.count()]).select_from(table)).scalar()
+    model.repo.commit()
+    return count
+
+
+
+def create_indexes(groups):
+    '''Creates the optional indexes of the given groups, see INDEXES.
+
+    Returns the names of the indexes that were created.
+    '''
+    created = []
+    for group in groups:
+        if group not in INDEXES:
+            raise ValueError('Unknown index group: {0}'.format(group))
+        for name, ddl in INDEXES[group]:
+            if name and model.Session.execute(
+                    text('SELECT 1 FROM pg_indexes WHERE indexname = :name'),
+                    {'name': name}).scalar():
+                continue
+            model.Session.execute(text(ddl.format(name)))
+            if name:
+                created.append(name)
+    model.repo.commit()
+    return created
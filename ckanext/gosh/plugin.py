@@ -1,8 +1,18 @@
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
+import ckan.model as model
 import ckanext.gosh.helpers as _helpers
+import ckanext.gosh.model as gosh_model
+from ckanext.gosh import autocomplete
+from ckanext.gosh import restricted
+from ckanext.gosh import scope as gosh_scope
+from ckanext.gosh import warmup
+from ckanext.gosh.cache import LRUCache
+from ckanext.gosh.metrics import metrics, MetricsMiddleware
+from ckanext.gosh.replica import replica, ReplicaMiddleware
+from ckanext.gosh.search_cache import search_cache
+import time
 import logging
-from email_validator import validate_email
 from ckan.lib.plugins import DefaultTranslation
 
 log = logging.getLogger(__name__)
@@ -23,6 +33,10 @@ def tc_end_validator(key, flattened_data, errors, context):
     return flattened_data
 
 
+def restricted_validator(value, context):
+    return restricted.normalize(value)
+
+
 def email_validator(key, data, errors, context):
     email = data[key]
     name = ''
@@ -32,14 +46,64 @@ def email_validator(key, data, errors, context):
         name = 'creator'
 
     if email != '':
+        if not is_valid_email(email):
+            raise toolkit.Invalid('Please provide a valid email address for ' + name)
+
+
+# Validation results by (address, check_deliverability). Syntax checks are
+# deterministic and cached either way, deliverability failures are not as
+# they may come from a DNS hiccup.
+email_cache = LRUCache(maxsize=10000, ttl=3600)
+
+# Whether validation looks up the domain's MX records. Turned off with
+# ckanext.gosh.email_validation = syntax, so bulk imports never wait on DNS.
+email_check_deliverability = True
+
+# email_validator pulls in dnspython, so it is only imported when first
+# needed (or by the warm-up)
+_validate_email = None
+
+
+def load_email_validator():
+    global _validate_email
+    if _validate_email is None:
+        from email_validator import validate_email
+        _validate_email = validate_email
+    return _validate_email
+
+
+def is_valid_email(email):
+    check_deliverability = email_check_deliverability
+    key = (email, check_deliverability)
+    valid = email_cache.get(key)
+    if valid is None:
+        validate_email = load_email_validator()
         try:
-            validate_email(email)
+            validate_email(email, check_deliverability=check_deliverability)
+            valid = True
         except Exception:
-            raise toolkit.Invalid('Please provide a valid email address for ' + name)
+            valid = False
+        if valid or not check_deliverability:
+            email_cache.set(key, valid)
+    return valid
+
+
+def _copy_schema(schema):
+    # Copies the dicts and validator lists, the validators themselves are
+    # shared
+    copy = {}
+    for key, value in schema.items():
+        if isinstance(value, dict):
+            value = _copy_schema(value)
+        elif isinstance(value, list):
+            value = list(value)
+        copy[key] = value
+    return copy
 
 
 class GoshPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm, DefaultTranslation):
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.IResourceController, inherit=True)
     plugins.implements(plugins.IDatasetForm, inherit=True)
@@ -47,6 +111,8 @@ class GoshPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm, DefaultTra
     plugins.implements(plugins.IRoutes)
     plugins.implements(plugins.ITranslation)
     plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
+    plugins.implements(plugins.IMiddleware, inherit=True)
 
     # IConfigurer
 
@@ -55,13 +121,68 @@ class GoshPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm, DefaultTra
         toolkit.add_public_directory(config_, 'public')
         toolkit.add_resource('fanstatic', 'gosh')
 
+    # IConfigurable
+
+    def configure(self, config_):
+        start = time.time()
+        gosh_model.setup()
+        _helpers.version_cache.ttl = int(
+            config_.get('ckanext.gosh.version_cache_ttl', 300))
+        gosh_scope.scope_cache.ttl = int(
+            config_.get('ckanext.gosh.auth_scope_ttl', 60))
+
+        from ckanext.gosh import actions
+        actions.set_json_decoder(config_.get('ckanext.gosh.json_decoder'))
+        search_cache.configure(config_)
+        metrics.configure(config_, model.meta.engine)
+        replica.configure(config_)
+        if replica.enabled:
+            metrics.configure(config_, replica.engine)
+
+        global email_check_deliverability
+        email_check_deliverability = config_.get(
+            'ckanext.gosh.email_validation', 'deliverability') != 'syntax'
+        restricted.typed = toolkit.asbool(
+            config_.get('ckanext.gosh.restricted_typed', False))
+
+        self._warmup = config_.get('ckanext.gosh.warmup', 'first_request')
+        log.info('Configured the gosh plugin in %.0fms',
+                 (time.time() - start) * 1000)
+        if self._warmup == 'configure' and warmup.warm_up(self):
+            # Don't hand the connections opened here down to forked workers
+            model.meta.engine.dispose()
+            replica.dispose()
+
     # IPackageController
 
-    def after_show(self, context, pkg_dict):
+    def after_create(self, context, pkg_dict):
+        self._package_changed(pkg_dict.get('id'))
+        return pkg_dict
 
-        pkg_dict.update({'identifier': pkg_dict.get('id')})
+    def after_update(self, context, pkg_dict):
+        self._package_changed(pkg_dict.get('id'))
         return pkg_dict
 
+    def after_delete(self, context, pkg_dict):
+        self._package_changed(pkg_dict.get('id'))
+        return pkg_dict
+
+    def _package_changed(self, id):
+        # package_delete may be called with the name instead of the id
+        package = model.Package.get(id) if id else None
+        if not package:
+            return
+        gosh_model.bump_package_version(package.id)
+        _helpers.version_cache.pop(package.id)
+        _helpers.fragment_cache.pop(package.id)
+        search_cache.invalidate_on_commit()
+        restricted.restricted_ids.update_package(package)
+        if autocomplete.index.ready:
+            autocomplete.index.update_package(package)
+
+    def before_index(self, pkg_dict):
+        return restricted.index_fields(pkg_dict)
+
     def before_view(self, pkg_dict):
 
         pkg_dict.update({'identifier': pkg_dict.get('id')})
@@ -77,6 +198,12 @@ class GoshPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm, DefaultTra
                      _redirect_code='301 Moved Permanently')
         map.redirect('/user/edit/{id:.*}', 'https://portal.rsrch.nl/',
                      _redirect_code='301 Moved Permanently')
+        map.connect('/gosh/metrics',
+                    controller='ckanext.gosh.controller:MetricsController',
+                    action='prometheus')
+        map.connect('/gosh/export.{format}',
+                    controller='ckanext.gosh.controller:ExportController',
+                    action='export', requirements={'format': 'jsonl|csv'})
         return map
 
     def after_map(self, map):
@@ -97,7 +224,9 @@ class GoshPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm, DefaultTra
                       email_validator,
                       toolkit.get_converter('convert_to_extras')]
         schema.update({
-            'restricted': defaults,
+            'restricted': [toolkit.get_validator('ignore_missing'),
+                           restricted_validator,
+                           toolkit.get_converter('convert_to_extras')],
             'number_of_participants': defaults,
             'url': validate_url,
             'author_email': valid_mail,
@@ -120,18 +249,44 @@ class GoshPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm, DefaultTra
         return schema
 
     def create_package_schema(self):
+        return self._cached_schema('create',
+                                   self._build_create_package_schema)
+
+    def update_package_schema(self):
+        return self._cached_schema('update',
+                                   self._build_update_package_schema)
+
+    def show_package_schema(self):
+        return self._cached_schema('show', self._build_show_package_schema)
+
+    # Built schemas by name. They never change once plugins are loaded, so
+    # they are built once and every caller gets its own copy to modify.
+    _schemas = {}
+
+    def _cached_schema(self, name, build):
+        schema = self._schemas.get(name)
+        if schema is None:
+            schema = self._schemas[name] = build()
+        return _copy_schema(schema)
+
+    def _build_schemas(self):
+        self.create_package_schema()
+        self.update_package_schema()
+        self.show_package_schema()
+
+    def _build_create_package_schema(self):
         schema = super(GoshPlugin, self).create_package_schema()
         schema = self._modify_package_schema(schema)
 
         return schema
 
-    def update_package_schema(self):
+    def _build_update_package_schema(self):
         schema = super(GoshPlugin, self).update_package_schema()
         schema = self._modify_package_schema(schema)
 
         return schema
 
-    def show_package_schema(self):
+    def _build_show_package_schema(self):
 
         schema = super(GoshPlugin, self).show_package_schema()
         not_empty = [toolkit.get_converter('convert_from_extras'),
@@ -169,6 +324,14 @@ class GoshPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm, DefaultTra
         # registers itself as the default (above).
         return []
 
+    def validate(self, context, data_dict, schema, action):
+        # gosh_package_bulk_upsert validates datasets ahead in its worker
+        # pool and passes the result along, so it isn't validated again
+        if action in ('package_create', 'package_update') and \
+                context.get('gosh_validated') is not None:
+            return context.pop('gosh_validated'), {}
+        return None
+
     def get_helpers(self):
         return {
             'language_options':
@@ -176,23 +339,28 @@ class GoshPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm, DefaultTra
             'get_language_by_code':
                 _helpers.get_language_by_code,
             'get_package_version':
-                _helpers.get_package_version
+                _helpers.get_package_version,
+            'gosh_linked_users':
+                _helpers.linked_users,
+            'gosh_cached_fragment':
+                _helpers.cached_fragment
         }
 
     def after_show(self, context, package_dict):
         # Takes care of package_show and resource_show
         package = context.get("package", None)
-        if package and package.extras.get("restricted",
-                                          0) == "1" and not toolkit.c.user:
+        if package and not restricted.can_view(package.id, toolkit.c.user,
+                                               package_dict):
             raise toolkit.NotAuthorized
+        package_dict.update({'identifier': package_dict.get('id')})
         return package_dict
 
     def before_search(self, search_params):
         # This takes care of package search
         fq = search_params.get("fq", "")
-        if not toolkit.c.user:
+        if restricted.hidden_for(toolkit.c.user):
             # There is no user logged in, hide the restricted datasets
-            fq = fq + " -extras_restricted:1"
+            fq = fq + " " + restricted.solr_fq()
         search_params["fq"] = fq
         search_params["include_private"] = True
         return search_params
@@ -200,12 +368,32 @@ class GoshPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm, DefaultTra
     def get_actions(self):
         from ckanext.gosh.actions import (package_autocomplete,
                                           package_search, resource_search,
-                                          user_list)
+                                          user_list, package_bulk_upsert,
+                                          gosh_metrics, package_show_many)
         # We're overloading few actions to get the benefits of private and
         # restricted browsing and searching
         return {
             'package_autocomplete': package_autocomplete,
             'package_search': package_search,
             'resource_search': resource_search,
-            'user_list': user_list
-        }
\ No newline at end of file
+            'user_list': user_list,
+            'gosh_package_bulk_upsert': package_bulk_upsert,
+            'gosh_metrics': gosh_metrics,
+            'gosh_package_show_many': package_show_many
+        }
+
+    # IAuthFunctions
+
+    def get_auth_functions(self):
+        from ckanext.gosh import auth
+        return {
+            'gosh_metrics': auth.gosh_metrics,
+            'gosh_package_show_many': auth.gosh_package_show_many
+        }
+
+    # IMiddleware
+
+    def make_middleware(self, app, config):
+        if getattr(self, '_warmup', None) == 'first_request':
+            app = warmup.WarmupMiddleware(app, self)
+        return MetricsMiddleware(ReplicaMiddleware(app))
\ No newline at end of file
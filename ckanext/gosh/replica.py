@@ -0,0 +1,210 @@
+'''Routes the reads of side-effect-free gosh actions to a replica database.
+
+Enabled by setting ``ckanext.gosh.replica.url`` to the SQLAlchemy URL of a
+read-only copy of the CKAN database (e.g. a PostgreSQL streaming
+replica). ``package_autocomplete``, ``resource_search``, the lean
+``user_list`` queries and the group titles ``package_search`` shows then
+run there, through their own connection pool, and the primary is left to
+writes.
+
+The primary is read from instead while any of these hold:
+
+* the replica is more than ``max_lag`` seconds behind. The lag is measured
+  at most every ``lag_check_interval`` seconds, and a replica that can't
+  be reached or measured counts as too far behind;
+* this worker committed a write less than ``max_lag`` seconds ago, so it
+  reads its own writes;
+* a query failed to reach the replica, until the next lag check.
+'''
+import logging
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+import ckan.model as model
+
+log = logging.getLogger(__name__)
+
+# Seconds of replay lag of a standby, 0 on a server that is not one or has
+# replayed everything it received
+_LAG_SQL = '''
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN {received}() = {replayed}() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+'''
+# Renamed in PostgreSQL 10
+_LAG_SQL_10 = _LAG_SQL.format(received='pg_last_wal_receive_lsn',
+                              replayed='pg_last_wal_replay_lsn')
+_LAG_SQL_9 = _LAG_SQL.format(received='pg_last_xlog_receive_location',
+                             replayed='pg_last_xlog_replay_location')
+
+
+class ReadReplica(object):
+    '''Hands out a session on the replica, or on ``primary`` when the
+    replica can't be trusted to be current.'''
+
+    def __init__(self, primary=None):
+        self.primary = primary if primary is not None else model.Session
+        self.engine = None
+        self.url = None
+        self.max_lag = 5.0
+        self.lag_check_interval = 5.0
+        self.last_write = 0
+        self.lag = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._session = scoped_session(sessionmaker(autoflush=False))
+
+    @property
+    def enabled(self):
+        return self.engine is not None
+
+    def configure(self, config):
+        self.max_lag = float(config.get('ckanext.gosh.replica.max_lag', 5))
+        self.lag_check_interval = float(
+            config.get('ckanext.gosh.replica.lag_check_interval', 5))
+
+        url = config.get('ckanext.gosh.replica.url') or None
+        if url == self.url:
+            return
+        self.dispose()
+        self.engine = None
+        if url:
+            options = {}
+            if not sqlalchemy.engine.url.make_url(url).drivername \
+                    .startswith('sqlite'):
+                options = {
+                    'pool_size': int(config.get(
+                        'ckanext.gosh.replica.pool_size', 5)),
+                    'max_overflow': int(config.get(
+                        'ckanext.gosh.replica.max_overflow', 10)),
+                    'pool_timeout': int(config.get(
+                        'ckanext.gosh.replica.pool_timeout', 30)),
+                    'pool_recycle': int(config.get(
+                        'ckanext.gosh.replica.pool_recycle', 3600)),
+                }
+            self.engine = sqlalchemy.create_engine(url, **options)
+        self._session.remove()
+        self._session.configure(bind=self.engine)
+        self.url = url
+        self.lag = None
+        self._checked = 0
+
+    def measure_lag(self):
+        '''Seconds the replica is behind, None if it can't be told.'''
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name != 'postgresql':
+                    connection.execute('SELECT 1')
+                    return 0.0
+                version = connection.dialect.server_version_info or (0,)
+                lag = connection.execute(
+                    _LAG_SQL_10 if version >= (10,) else _LAG_SQL_9).scalar()
+        except DBAPIError as e:
+            log.warning('Could not check the read replica, reading from the '
+                        'primary: %s', e)
+            return None
+        return None if lag is None else float(lag)
+
+    def current(self):
+        '''True if reads may go to the replica now.'''
+        if self.engine is None:
+            return False
+        now = time.time()
+        if now - self.last_write < self.max_lag:
+            return False
+        if now - self._checked > self.lag_check_interval:
+            with self._lock:
+                if now - self._checked > self.lag_check_interval:
+                    self.lag = self.measure_lag()
+                    self._checked = time.time()
+                    if self.lag is not None and self.lag > self.max_lag:
+                        log.info('The read replica is %.1fs behind, reading '
+                                 'from the primary', self.lag)
+        return self.lag is not None and self.lag <= self.max_lag
+
+    def session(self):
+        '''The session reads should use now, the thread's ``Session`` of
+        the replica or of the primary (not the ``scoped_session``, which
+        ``Query.with_session`` can't use).
+
+        Replica sessions are removed at the end of each request, see
+        ``ReplicaMiddleware``.
+        '''
+        return self._session() if self.current() else self.primary()
+
+    def run(self, function):
+        '''Returns ``function(session)``, run on the session reads should
+        use now. Run again on the primary if the replica can't be reached.
+        '''
+        if not self.current():
+            return function(self.primary())
+        try:
+            return function(self._session())
+        except DBAPIError as e:
+            if not (e.connection_invalidated or
+                    isinstance(e, OperationalError)):
+                raise
+            log.warning('Read replica query failed, retrying on the '
+                        'primary: %s', e)
+            self._session.remove()
+            with self._lock:
+                self.lag = None
+                self._checked = time.time()
+            return function(self.primary())
+
+    def remove(self):
+        if self.engine is not None:
+            self._session.remove()
+
+    def dispose(self):
+        '''Closes the pooled connections, e.g. before forking workers.'''
+        if self.engine is not None:
+            self._session.remove()
+            self.engine.dispose()
+
+    def stats(self):
+        return {'enabled': self.enabled,
+                'lag': self.lag,
+                'last_write': self.last_write}
+
+
+replica = ReadReplica()
+
+
+class ReplicaMiddleware(object):
+    '''Returns the replica connection of a request to the pool when it
+    ends.'''
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        try:
+            return self.app(environ, start_response)
+        finally:
+            replica.remove()
+
+
+def _flushed(session, flush_context):
+    session.info['gosh_wrote'] = True
+
+
+def _committed(session):
+    if session.info.pop('gosh_wrote', False):
+        replica.last_write = time.time()
+
+
+def _rolled_back(session):
+    session.info.pop('gosh_wrote', None)
+
+
+event.listen(model.Session, 'after_flush', _flushed)
+event.listen(model.Session, 'after_commit', _committed)
+event.listen(model.Session, 'after_rollback', _rolled_back)
@@ -0,0 +1,171 @@
+'''The "GOSH restricted" visibility rule, in one place.
+
+Datasets with the ``restricted`` extra set to "1" are hidden from anonymous
+users. Every path that enforces it goes through this module: package_show
+(``after_show``), package_search (``solr_fq``), and the SQL behind
+package_autocomplete and resource_search (``sql_clause``).
+'''
+import time
+import logging
+import threading
+
+from sqlalchemy import and_, exists, text
+
+import ckan.model as model
+
+log = logging.getLogger(__name__)
+
+KEY = 'restricted'
+VALUE = '1'
+
+# Typed boolean Solr field, see solr_fq
+SOLR_FIELD = 'gosh_restricted'
+
+# Values the migration and the schema normalize to VALUE
+_TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+# Set by the plugin from ckanext.gosh.restricted_typed once every dataset
+# has been migrated and reindexed
+typed = False
+
+
+def hidden_for(user):
+    '''Whether restricted datasets are hidden from ``user``.'''
+    return not user
+
+
+def is_restricted_value(value):
+    return value == VALUE
+
+
+def normalize(value):
+    '''Maps the free-form values the extra used to hold to "1" or "0".'''
+    if value is None:
+        return value
+    return VALUE if unicode(value).strip().lower() in _TRUE_VALUES else '0'
+
+
+def is_restricted_dict(pkg_dict):
+    '''Checks a package dict, with ``restricted`` either converted from the
+    extras by the show schema or still in the extras list.'''
+    if KEY in pkg_dict:
+        return is_restricted_value(pkg_dict[KEY])
+    for extra in pkg_dict.get('extras') or []:
+        if extra.get('key') == KEY:
+            return is_restricted_value(extra.get('value'))
+    return False
+
+
+def solr_fq():
+    '''Filter query excluding restricted datasets from Solr searches.
+
+    Matches the indexed boolean field once datasets are migrated, the
+    tokenized text of the extra before that.
+    '''
+    if typed:
+        return '-{0}:true'.format(SOLR_FIELD)
+    return '-extras_restricted:1'
+
+
+def index_fields(pkg_dict):
+    '''Adds the typed flag to a dataset's Solr document.'''
+    pkg_dict[SOLR_FIELD] = is_restricted_value(
+        pkg_dict.get('extras_' + KEY))
+    return pkg_dict
+
+
+def sql_clause(package_id):
+    '''Correlated EXISTS matching restricted datasets.
+
+    Negate it to anti-join restricted datasets away in the same query that
+    fetches the rows.
+    '''
+    extra = model.package_extra_table
+    return exists().where(and_(extra.c.package_id == package_id,
+                               extra.c.key == KEY,
+                               extra.c.value == VALUE,
+                               extra.c.state == 'active'))
+
+
+class RestrictedIds(object):
+    '''Ids of all restricted datasets, held in memory.
+
+    Loaded with one query on first use. The package hooks of this worker
+    keep it current, and it is reloaded every ``refresh_interval`` seconds
+    to pick up changes made by other workers.
+    '''
+
+    refresh_interval = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = None
+        self._loaded = 0
+
+    def load(self):
+        extra = model.package_extra_table
+        ids = frozenset(
+            row[0] for row in model.Session.query(extra.c.package_id)
+            .filter(extra.c.key == KEY)
+            .filter(extra.c.value == VALUE)
+            .filter(extra.c.state == 'active'))
+        with self._lock:
+            self._ids = ids
+            self._loaded = time.time()
+        return ids
+
+    def ids(self):
+        ids = self._ids
+        if ids is None or time.time() - self._loaded > self.refresh_interval:
+            ids = self.load()
+        return ids
+
+    def __contains__(self, package_id):
+        return package_id in self.ids()
+
+    def update_package(self, package):
+        if self._ids is None:
+            return
+        with self._lock:
+            if is_restricted_value(package.extras.get(KEY)):
+                self._ids = self._ids | frozenset([package.id])
+            else:
+                self._ids = self._ids - frozenset([package.id])
+
+
+restricted_ids = RestrictedIds()
+
+
+def can_view(package_id, user, pkg_dict=None):
+    '''Whether ``user`` may see the dataset.
+
+    The id set answers without touching the database. A package dict at
+    hand is checked as well, so a change made by another worker since the
+    set's last reload can't expose a dataset.
+    '''
+    if not hidden_for(user):
+        return True
+    if package_id in restricted_ids:
+        return False
+    return not (pkg_dict and is_restricted_dict(pkg_dict))
+
+
+def migrate():
+    '''Normalizes every stored value of the extra to "1" or "0".
+
+    Returns the ids of all datasets that have the extra, which need
+    reindexing to get the typed Solr field.
+    '''
+    extra = model.package_extra_table
+    changed = model.Session.execute(text(
+        "UPDATE package_extra SET value = CASE "
+        "WHEN lower(trim(value)) IN :true_values THEN :yes ELSE '0' END "
+        "WHERE key = :key AND value NOT IN (:yes, '0')"),
+        {'key': KEY, 'yes': VALUE,
+         'true_values': _TRUE_VALUES}).rowcount
+    ids = [row[0] for row in model.Session.query(extra.c.package_id)
+           .filter(extra.c.key == KEY).distinct()]
+    model.repo.commit()
+    log.info('Normalized %s restricted values, %s datasets to reindex',
+             changed, len(ids))
+    return ids
@@ -0,0 +1,105 @@
+import hashlib
+import logging
+
+from sqlalchemy import event
+
+import ckan.logic as logic
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.gosh.cache import LRUCache
+from ckanext.gosh.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Request environ key holding the scopes already resolved in this request
+_ENVIRON_KEY = 'ckanext.gosh.auth_scope'
+
+
+class AuthScope(object):
+    '''What a user may see in searches.
+
+    Holds the sysadmin flag, the user id and the ids of the organizations
+    the user can read, so search actions don't have to look them up again.
+    '''
+
+    __slots__ = ('user', 'user_id', 'sysadmin', 'org_ids')
+
+    def __init__(self, user=None, user_id=None, sysadmin=False, org_ids=()):
+        self.user = user
+        self.user_id = user_id
+        self.sysadmin = sysadmin
+        self.org_ids = tuple(sorted(org_ids))
+
+    def cache_key(self, include_drafts=False):
+        '''Identifies everyone who sees the same search results.'''
+        if not self.user:
+            return 'anonymous'
+        if self.sysadmin:
+            return 'sysadmin'
+        key = 'orgs:' + hashlib.sha1(
+            u' '.join(self.org_ids).encode('utf-8')).hexdigest()
+        if include_drafts:
+            # Drafts are only visible to their creator
+            key += ':user:{0}'.format(self.user_id)
+        return key
+
+
+ANONYMOUS = AuthScope()
+
+# Scopes by user name, shared by the requests of this worker
+scope_cache = LRUCache(maxsize=2000, ttl=60)
+
+
+def get_scope(user):
+    '''Returns the AuthScope of ``user``.
+
+    Scopes are memoized for the current request and cached across requests
+    for ``scope_cache.ttl`` seconds. Membership, organization and user
+    changes made in this worker clear the cache right away.
+    '''
+    if not user:
+        return ANONYMOUS
+
+    request_scopes = _request_scopes()
+    scope = request_scopes.get(user)
+    if scope is None:
+        scope = scope_cache.get(user)
+        if scope is None:
+            scope = _build_scope(user)
+            scope_cache.set(user, scope)
+        request_scopes[user] = scope
+    return scope
+
+
+def _build_scope(user):
+    user_obj = model.User.get(user)
+    if not user_obj:
+        # Unknown users (e.g. deleted since they logged in) see what
+        # anonymous users see
+        return ANONYMOUS
+    if user_obj.sysadmin:
+        return AuthScope(user, user_obj.id, sysadmin=True)
+    with metrics.span('organization_list_for_user'):
+        orgs = logic.get_action('organization_list_for_user')(
+            {'user': user}, {'permission': 'read'})
+    return AuthScope(user, user_obj.id,
+                     org_ids=[org['id'] for org in orgs])
+
+
+def _request_scopes():
+    try:
+        environ = toolkit.request.environ
+    except (TypeError, AttributeError):
+        # Outside of a web request, e.g. in a paster command
+        return {}
+    return environ.setdefault(_ENVIRON_KEY, {})
+
+
+def _invalidate(mapper, connection, target):
+    scope_cache.clear()
+
+
+for _class in (model.Member, model.Group, model.User):
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_class, _event, _invalidate)
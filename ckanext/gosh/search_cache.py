@@ -0,0 +1,143 @@
+import json
+import uuid
+import hashlib
+import logging
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from paste.deploy.converters import asbool
+from sqlalchemy import event
+
+import ckan.model as model
+
+from ckanext.gosh.cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+_GENERATION_KEY = 'gosh:search:generation'
+
+
+class LocalBackend(object):
+    '''Default backend, an LRU cache in the worker's memory.
+
+    Other backends (e.g. Redis or memcached, shared by all workers) only need
+    the same ``get(key)`` and ``set(key, value, ttl)`` methods and a
+    constructor taking the CKAN config. A ``ttl`` of None means the value
+    must not expire or be evicted.
+    '''
+
+    def __init__(self, config):
+        self._cache = LRUCache(
+            maxsize=int(config.get('ckanext.gosh.search_cache.size', 1000)))
+        # Values without a TTL (the generation token) are kept out of the LRU
+        self._pinned = {}
+
+    def get(self, key):
+        if key in self._pinned:
+            return self._pinned[key]
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl):
+        if ttl is None:
+            self._pinned[key] = value
+        else:
+            self._cache.set(key, value)
+
+
+class SearchCache(object):
+    '''Caches package_search results by search params and access scope.
+
+    Results are stored pickled, so callers can change what they get back.
+    Every key includes a generation token, and any dataset change replaces
+    the token, so all earlier entries go stale at once.
+
+    The token is replaced once the change is committed (see
+    ``invalidate_on_commit``), not while it is still being written, so a
+    search running in between can't store the old results under the new
+    token.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.ttl = 60
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, config):
+        self.enabled = asbool(config.get('ckanext.gosh.search_cache', False))
+        self.ttl = int(config.get('ckanext.gosh.search_cache.ttl', 60))
+        backend = config.get('ckanext.gosh.search_cache.backend')
+        if backend:
+            module_name, class_name = backend.split(':', 1)
+            module = __import__(module_name, fromlist=[class_name])
+            self.backend = getattr(module, class_name)(config)
+        else:
+            self.backend = LocalBackend(config)
+        # The local backend has no TTL of its own
+        if isinstance(self.backend, LocalBackend):
+            self.backend._cache.ttl = self.ttl
+
+    def key(self, data_dict, scope_key):
+        params = dict(data_dict)
+        for name in ('q', 'fq'):
+            if isinstance(params.get(name), basestring):
+                params[name] = ' '.join(params[name].split())
+        blob = json.dumps([self._generation(), scope_key, params],
+                          sort_keys=True, default=unicode)
+        return 'gosh:search:' + hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key, search_results):
+        self.backend.set(key, pickle.dumps(search_results,
+                                           pickle.HIGHEST_PROTOCOL),
+                         self.ttl)
+
+    def invalidate(self):
+        if self.backend is not None:
+            self.backend.set(_GENERATION_KEY, uuid.uuid4().hex, None)
+
+    def invalidate_on_commit(self, session=None):
+        '''Invalidates once the current transaction of ``session`` (by
+        default ``model.Session``) commits, and not at all if it rolls
+        back.'''
+        session = session if session is not None else model.Session()
+        session.info['gosh_search_changed'] = True
+
+    def _generation(self):
+        generation = self.backend.get(_GENERATION_KEY)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.backend.set(_GENERATION_KEY, generation, None)
+        return generation
+
+    def stats(self):
+        return {'enabled': self.enabled,
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+search_cache = SearchCache()
+
+
+def _committed(session):
+    if session.info.pop('gosh_search_changed', False):
+        search_cache.invalidate()
+
+
+def _rolled_back(session):
+    session.info.pop('gosh_search_changed', None)
+
+
+event.listen(model.Session, 'after_commit', _committed)
+event.listen(model.Session, 'after_rollback', _rolled_back)
@@ -0,0 +1,54 @@
+"""Per-dataset cost of validating author and maintainer emails.
+
+Compares validating every address from scratch, as every create/update did
+before, with the cached validation, over a harvest-like batch where few
+distinct addresses repeat across many datasets::
+
+    python -m ckanext.gosh.tests.benchmarks.bench_email [--deliverability]
+
+``--deliverability`` also measures the default mode, which does DNS
+lookups and therefore needs network access.
+"""
+import sys
+import time
+
+import ckanext.gosh.plugin as plugin
+
+DATASETS = 2000
+DISTINCT_ADDRESSES = 40
+
+
+def _datasets():
+    return [{('author_email',): 'author{0}@example.org'.format(
+                 i % DISTINCT_ADDRESSES),
+             ('maintainer_email',): 'data-office@example.org'}
+            for i in range(DATASETS)]
+
+
+def _run(datasets, cached):
+    plugin.email_cache.clear()
+    start = time.time()
+    for data in datasets:
+        if not cached:
+            plugin.email_cache.clear()
+        for key in data:
+            plugin.email_validator(key, data, {}, {})
+    return (time.time() - start) / len(datasets)
+
+
+def main(argv):
+    datasets = _datasets()
+    modes = [False, True] if '--deliverability' in argv else [False]
+    for check_deliverability in modes:
+        plugin.email_check_deliverability = check_deliverability
+        mode = 'deliverability' if check_deliverability else 'syntax'
+        before = _run(datasets, cached=False)
+        after = _run(datasets, cached=True)
+        print('{0:>14}: uncached {1:8.1f} us/dataset, cached {2:8.1f} '
+              'us/dataset ({3:.0f}x)'.format(
+                  mode, before * 1e6, after * 1e6,
+                  before / after if after else 0))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,34 @@
+"""Per-call cost of the dataset schemas GoshPlugin hands out.
+
+Compares building each schema from the core defaults, as every call did
+before, with copying the cached one::
+
+    python -m ckanext.gosh.tests.benchmarks.bench_schemas
+
+Needs a CKAN config with the gosh plugin enabled, e.g. via
+``CKAN_INI=test.ini``, so validators can be resolved.
+"""
+import timeit
+
+import ckan.plugins as plugins
+
+from ckanext.gosh.plugin import GoshPlugin
+
+CALLS = 2000
+
+
+def main():
+    plugin = plugins.get_plugin('gosh') or GoshPlugin()
+    for name in ('create', 'update', 'show'):
+        build = getattr(plugin, '_build_{0}_package_schema'.format(name))
+        cached = getattr(plugin, '{0}_package_schema'.format(name))
+        cached()
+        before = timeit.timeit(build, number=CALLS) / CALLS
+        after = timeit.timeit(cached, number=CALLS) / CALLS
+        print('{0:>6}: build {1:8.1f} us/call, cached copy {2:8.1f} us/call '
+              '({3:.0f}x)'.format(name, before * 1e6, after * 1e6,
+                                  before / after if after else 0))
+
+
+if __name__ == '__main__':
+    main()
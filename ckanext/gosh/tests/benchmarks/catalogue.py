@@ -0,0 +1,242 @@
+'''Generated catalogues for the benchmark suite.
+
+``load(size)`` writes ``size`` datasets, with their extras, resources, tags,
+organizations and users, straight into the database with batched inserts,
+and indexes matching documents into a fake Solr. Going through the actions
+would take hours for the larger sizes, and what is measured is reading the
+catalogue, not building it.
+
+The data is derived from the dataset number only, so every run with the
+same size loads the same catalogue.
+'''
+import datetime
+import json
+import uuid
+
+import ckan.model as model
+from ckan.model import meta
+
+from ckanext.gosh import restricted
+
+BATCH_SIZE = 1000
+
+ORGANIZATIONS = 20
+GROUPS = 10
+TAGS = 200
+RESOURCES_PER_DATASET = 2
+FORMATS = ('CSV', 'XLS', 'JSON', 'PDF', 'ZIP')
+LANGUAGES = ('en', 'fr', 'de', 'es')
+WORDS = ('blood', 'cohort', 'genome', 'clinical', 'trial', 'imaging',
+         'survey', 'paediatric', 'registry', 'outcomes', 'sample', 'cancer')
+
+# Every 10th dataset is private, every 7th restricted, every 50th a draft
+PRIVATE_EVERY = 10
+RESTRICTED_EVERY = 7
+DRAFT_EVERY = 50
+
+SYSADMIN = 'bench-sysadmin'
+EDITOR = 'bench-editor'
+
+_EPOCH = datetime.datetime(2015, 1, 1)
+
+
+class Catalogue(object):
+    '''What a loaded catalogue holds, for the benchmark cases to query.'''
+
+    def __init__(self, size, organizations, users, package_ids):
+        self.size = size
+        self.organizations = organizations
+        self.users = users
+        self.package_ids = package_ids
+        self.sysadmin = SYSADMIN
+        self.editor = EDITOR
+
+
+def _id(kind, number):
+    return unicode(uuid.uuid5(uuid.NAMESPACE_URL,
+                              'gosh-bench:{0}:{1}'.format(kind, number)))
+
+
+def _words(number, count):
+    return [WORDS[(number * 7 + i * 3) % len(WORDS)] for i in range(count)]
+
+
+def _dataset(number, organizations):
+    modified = _EPOCH + datetime.timedelta(minutes=number * 17)
+    words = _words(number, 3)
+    return {
+        'id': _id('package', number),
+        'name': u'bench-{0}-{1:06d}'.format(words[0], number),
+        'title': u'{0} {1} study {2}'.format(
+            words[0].title(), words[1], number),
+        'notes': u'Generated {0} dataset about {1} and {2}.'.format(
+            words[0], words[1], words[2]),
+        'license_id': u'cc-by',
+        'type': u'dataset',
+        'owner_org': organizations[number % len(organizations)]['id'],
+        'private': number % PRIVATE_EVERY == 0,
+        'state': u'draft' if number % DRAFT_EVERY == 1 else u'active',
+        'metadata_created': modified,
+        'metadata_modified': modified,
+        'maintainer': u'Maintainer {0}'.format(number % 40),
+        'maintainer_email': u'maintainer{0}@example.org'.format(number % 40),
+        'author': u'Author {0}'.format(number % 80),
+        'author_email': u'author{0}@example.org'.format(number % 80),
+    }
+
+
+def _extras(number):
+    return {
+        restricted.KEY: (restricted.VALUE if number % RESTRICTED_EVERY == 0
+                         else u'0'),
+        'language': LANGUAGES[number % len(LANGUAGES)],
+        'number_of_participants': unicode(number % 5000),
+        'number_of_records': unicode(number % 9000),
+        'human_research': u'yes' if number % 2 else u'no',
+        'tc_start': u'2010-01-01',
+    }
+
+
+def _resources(number):
+    return [{
+        'id': _id('resource', number * RESOURCES_PER_DATASET + i),
+        'package_id': _id('package', number),
+        'url': u'http://example.org/{0}/{1}.csv'.format(number, i),
+        'format': FORMATS[(number + i) % len(FORMATS)],
+        'name': u'{0} file {1}'.format(_words(number, 1)[0], i),
+        'description': u'Resource {0} of dataset {1}'.format(i, number),
+        'position': i,
+        'state': u'active',
+        'extras': {'schema_version': unicode(1 + number % 3)},
+    } for i in range(RESOURCES_PER_DATASET)]
+
+
+def _solr_doc(dataset, extras, resources, tags, groups, organization):
+    data_dict = dict(dataset,
+                     metadata_created=dataset['metadata_created'].isoformat(),
+                     metadata_modified=dataset['metadata_modified']
+                     .isoformat(),
+                     organization={'id': organization['id'],
+                                   'name': organization['name'],
+                                   'title': organization['title']},
+                     groups=[{'name': name} for name in groups],
+                     tags=[{'name': name} for name in tags],
+                     resources=[dict(r, extras=None) for r in resources],
+                     extras=[{'key': key, 'value': value}
+                             for key, value in sorted(extras.items())])
+    data_dict.update(extras)
+    blob = json.dumps(data_dict)
+    doc = {
+        'id': dataset['id'],
+        'index_id': dataset['id'],
+        'site_id': 'default',
+        'name': dataset['name'],
+        'title': dataset['title'],
+        'notes': dataset['notes'],
+        'state': dataset['state'],
+        'capacity': 'private' if dataset['private'] else 'public',
+        'owner_org': dataset['owner_org'],
+        'organization': organization['name'],
+        'groups': groups,
+        'tags': tags,
+        'res_format': [r['format'] for r in resources],
+        'license_id': dataset['license_id'],
+        'metadata_modified': data_dict['metadata_modified'] + 'Z',
+        'metadata_created': data_dict['metadata_created'] + 'Z',
+        'data_dict': blob,
+        'validated_data_dict': blob,
+    }
+    for key, value in extras.items():
+        doc['extras_' + key] = value
+    return restricted.index_fields(doc)
+
+
+def _insert(table, rows):
+    if rows:
+        model.Session.execute(table.insert(), rows)
+
+
+def load(size, solr):
+    '''Replaces the database contents and ``solr``'s documents with a
+    catalogue of ``size`` datasets.'''
+    model.repo.rebuild_db()
+    solr.delete(q='*:*')
+
+    organizations = [{'id': _id('organization', i),
+                      'name': u'bench-org-{0}'.format(i),
+                      'title': u'Bench Organization {0}'.format(i),
+                      'type': u'organization', 'is_organization': True,
+                      'approval_status': u'approved', 'state': u'active'}
+                     for i in range(ORGANIZATIONS)]
+    groups = [{'id': _id('group', i),
+               'name': u'bench-group-{0}'.format(i),
+               'title': u'Bench Group {0}'.format(i),
+               'type': u'group', 'is_organization': False,
+               'approval_status': u'approved', 'state': u'active'}
+              for i in range(GROUPS)]
+    users = [{'id': _id('user', i),
+              'name': u'bench-user-{0}'.format(i),
+              'fullname': u'Bench User {0}'.format(i),
+              'email': u'user{0}@example.org'.format(i),
+              'sysadmin': False, 'state': u'active',
+              'created': _EPOCH}
+             for i in range(max(10, size // 10))]
+    users[0].update(name=SYSADMIN, sysadmin=True)
+    users[1].update(name=EDITOR)
+    tags = [{'id': _id('tag', i), 'name': u'tag-{0}'.format(i)}
+            for i in range(TAGS)]
+
+    _insert(model.group_table, organizations + groups)
+    _insert(model.user_table, users)
+    _insert(model.tag_table, tags)
+    # The editor can read the private datasets of the first organization
+    _insert(model.member_table, [{
+        'id': _id('member', 0), 'table_id': users[1]['id'],
+        'table_name': u'user', 'group_id': organizations[0]['id'],
+        'capacity': u'editor', 'state': u'active'}])
+
+    package_ids = []
+    for start in range(0, size, BATCH_SIZE):
+        numbers = range(start, min(size, start + BATCH_SIZE))
+        datasets, extra_rows, resource_rows = [], [], []
+        tag_rows, member_rows, docs = [], [], []
+        for number in numbers:
+            dataset = _dataset(number, organizations)
+            extras = _extras(number)
+            resources = _resources(number)
+            dataset_tags = [tags[(number + i * 31) % TAGS]
+                            for i in range(3)]
+            group = groups[number % GROUPS]
+
+            datasets.append(dataset)
+            package_ids.append(dataset['id'])
+            extra_rows.extend({'id': _id('extra:' + key, number),
+                               'package_id': dataset['id'],
+                               'key': key, 'value': value,
+                               'state': u'active'}
+                              for key, value in extras.items())
+            resource_rows.extend(resources)
+            tag_rows.extend({'id': _id('package_tag:' + tag['id'], number),
+                             'package_id': dataset['id'],
+                             'tag_id': tag['id'], 'state': u'active'}
+                            for tag in dataset_tags)
+            member_rows.append({'id': _id('member:' + group['id'], number),
+                                'table_id': dataset['id'],
+                                'table_name': u'package',
+                                'group_id': group['id'],
+                                'capacity': u'public', 'state': u'active'})
+            docs.append(_solr_doc(
+                dataset, extras, resources,
+                [tag['name'] for tag in dataset_tags], [group['name']],
+                organizations[number % ORGANIZATIONS]))
+
+        _insert(model.package_table, datasets)
+        _insert(model.package_extra_table, extra_rows)
+        _insert(model.resource_table, resource_rows)
+        _insert(model.package_tag_table, tag_rows)
+        _insert(model.member_table, member_rows)
+        model.Session.commit()
+        solr.add(docs)
+
+    meta.Session.remove()
+    return Catalogue(size, organizations, users, package_ids)
@@ -0,0 +1,341 @@
+'''An in-process stand-in for the Solr server, for benchmarks and tests.
+
+Holds documents in memory and answers the subset of the query syntax CKAN
+and the gosh actions send: ``*:*`` or plain terms in ``q``, field clauses
+(quoted, bare or ``(a OR b)`` values, ``+``/``-`` prefixes, ``AND``/``OR``
+and parentheses) in ``q`` and ``fq``, ``sort``, ``start``/``rows``,
+``cursorMark``, ``fl`` and field facets. Relevance is not scored, so
+``score`` sorts are ignored.
+
+``install()`` makes ``ckan.lib.search`` use it instead of pysolr, until
+``uninstall()``.
+'''
+import re
+import json
+import base64
+import threading
+
+_TOKEN = re.compile(r'\s*(\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+)')
+
+# (module, make_connection) pairs replaced by install()
+_originals = None
+
+
+class Results(object):
+    '''The parts of ``pysolr.Results`` CKAN reads.'''
+
+    def __init__(self, docs, hits, facets=None, next_cursor_mark=None):
+        self.docs = docs
+        self.hits = hits
+        self.facets = facets or {}
+        self.nextCursorMark = next_cursor_mark
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+class FakeSolr(object):
+
+    url = 'fake-solr://'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.docs = {}
+        self.searches = 0
+
+    # Indexing
+
+    def add(self, docs, commit=True, **kwargs):
+        with self._lock:
+            for doc in docs:
+                self.docs[doc.get('index_id') or doc['id']] = dict(doc)
+
+    def delete(self, id=None, q=None, commit=True, **kwargs):
+        with self._lock:
+            if id is not None:
+                self.docs.pop(id, None)
+            elif q in (None, '*:*'):
+                self.docs.clear()
+            else:
+                match = parse(q)
+                for key, doc in list(self.docs.items()):
+                    if match(doc):
+                        del self.docs[key]
+
+    def commit(self, **kwargs):
+        pass
+
+    # Searching
+
+    def search(self, q='*:*', **params):
+        self.searches += 1
+        fq = params.get('fq') or []
+        if isinstance(fq, basestring):
+            fq = [fq]
+        filters = [parse(f) for f in fq if f and f.strip()]
+        if q and q.strip() not in ('*:*', '""', "''"):
+            if ':' in q:
+                filters.append(parse(q))
+            else:
+                filters.append(_text_match(q))
+
+        with self._lock:
+            docs = list(self.docs.values())
+        docs = [doc for doc in docs if all(match(doc) for match in filters)]
+        hits = len(docs)
+        docs = _sort(docs, params.get('sort'))
+
+        facets = {}
+        if _is_true(params.get('facet')) and params.get('facet.field'):
+            facets['facet_fields'] = _facets(
+                docs, params['facet.field'],
+                int(params.get('facet.limit', 50)),
+                int(params.get('facet.mincount', 1)))
+
+        start = int(params.get('start') or 0)
+        rows = int(params.get('rows', 10))
+        next_cursor_mark = None
+        cursor_mark = params.get('cursorMark')
+        if cursor_mark is not None:
+            docs, next_cursor_mark = _cursor_page(
+                docs, params.get('sort'), cursor_mark, start, rows)
+            start = 0
+        fields = (params.get('fl') or '*').replace(',', ' ').split()
+        page = [_project(doc, fields) for doc in docs[start:start + rows]]
+        return Results(page, hits, facets, next_cursor_mark)
+
+
+def install(solr=None):
+    '''Points ``ckan.lib.search`` at ``solr`` (a new FakeSolr by default),
+    and returns it.'''
+    import ckan.lib.search.common as common
+    import ckan.lib.search.index as index
+    import ckan.lib.search.query as query
+
+    global _originals
+    solr = solr or FakeSolr()
+
+    def make_connection(decode_dates=True):
+        return solr
+
+    modules = (common, index, query)
+    if _originals is None:
+        _originals = [(module, module.make_connection) for module in modules]
+    for module in modules:
+        module.make_connection = make_connection
+    return solr
+
+
+def uninstall():
+    '''Puts back the connections ``install()`` replaced.'''
+    global _originals
+    for module, make_connection in _originals or []:
+        module.make_connection = make_connection
+    _originals = None
+
+
+# Query parsing
+
+def parse(query):
+    '''Compiles a query into a predicate on documents.'''
+    tokens = _TOKEN.findall(query)
+    match, position = _parse_or(tokens, 0)
+    return match
+
+
+def _parse_or(tokens, position):
+    alternatives = []
+    while True:
+        match, position = _parse_and(tokens, position)
+        alternatives.append(match)
+        if position < len(tokens) and tokens[position] == 'OR':
+            position += 1
+            continue
+        break
+    if len(alternatives) == 1:
+        return alternatives[0], position
+    return (lambda doc: any(m(doc) for m in alternatives)), position
+
+
+def _parse_and(tokens, position):
+    required = []
+    while position < len(tokens) and tokens[position] not in (')', 'OR'):
+        if tokens[position] == 'AND':
+            position += 1
+            continue
+        match, position = _parse_clause(tokens, position)
+        required.append(match)
+    return (lambda doc: all(m(doc) for m in required)), position
+
+
+def _parse_clause(tokens, position):
+    token = tokens[position]
+    negate = False
+    if token[0] in '+-' and len(token) > 1:
+        negate = token[0] == '-'
+        token = token[1:]
+    elif token in ('+', '-'):
+        negate = token == '-'
+        position += 1
+        token = tokens[position]
+
+    if token == '(':
+        match, position = _parse_or(tokens, position + 1)
+        position += 1  # ')'
+    elif ':' in token:
+        field, value = token.split(':', 1)
+        if value:
+            values = [_unquote(value)]
+            position += 1
+        else:
+            values, position = _parse_values(tokens, position + 1)
+        match = _field_match(field, values)
+    else:
+        match = _text_match(_unquote(token))
+        position += 1
+
+    if negate:
+        return (lambda doc: not match(doc)), position
+    return match, position
+
+
+def _parse_values(tokens, position):
+    if tokens[position] != '(':
+        return [_unquote(tokens[position])], position + 1
+    values = []
+    position += 1
+    while tokens[position] != ')':
+        if tokens[position] not in ('OR', 'AND'):
+            values.append(_unquote(tokens[position]))
+        position += 1
+    return values, position + 1
+
+
+def _unquote(value):
+    if len(value) > 1 and value[0] == value[-1] == '"':
+        value = value[1:-1].replace('\\"', '"')
+    return value
+
+
+def _as_strings(value):
+    if value is None:
+        return []
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    strings = []
+    for item in value:
+        if isinstance(item, bool):
+            item = 'true' if item else 'false'
+        strings.append(unicode(item))
+    return strings
+
+
+def _field_match(field, values):
+    def match(doc):
+        present = _as_strings(doc.get(field))
+        if '*' in values:
+            return bool(present)
+        return any(value in present for value in values)
+    return match
+
+
+def _text_match(q):
+    terms = q.lower().split()
+
+    def match(doc):
+        text = u' '.join(
+            u' '.join(_as_strings(doc.get(field)))
+            for field in ('name', 'title', 'notes', 'tags', 'text')).lower()
+        return all(term in text for term in terms)
+    return match
+
+
+# Results
+
+def _sort(docs, sort):
+    for clause in reversed((sort or '').split(',')):
+        parts = clause.split()
+        if not parts or parts[0] == 'score':
+            continue
+        field = parts[0]
+        reverse = len(parts) > 1 and parts[1].lower() == 'desc'
+        # Documents without the field sort last, as in Solr
+        present = [doc for doc in docs if doc.get(field) is not None]
+        missing = [doc for doc in docs if doc.get(field) is None]
+        present.sort(key=lambda doc: doc[field], reverse=reverse)
+        docs = present + missing
+    return docs
+
+
+class _Descending(object):
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _cursor_page(docs, sort, cursor_mark, start, rows):
+    '''The documents after ``cursor_mark`` and the mark of the next page.
+
+    Marks encode the sort values of a page's last document, so they stay
+    valid when documents are added or removed in between, as in Solr.
+    '''
+    clauses = [clause.split() for clause in (sort or '').split(',')
+               if clause.strip() and clause.split()[0] != 'score']
+    if start or 'id' not in [clause[0] for clause in clauses]:
+        raise ValueError('Cursor paging needs start=0 and an id sort')
+
+    def key(values):
+        return tuple(
+            _Descending(value) if len(clause) > 1 and
+            clause[1].lower() == 'desc' else value
+            for clause, value in zip(clauses, values))
+
+    def values(doc):
+        return [doc.get(clause[0]) or u'' for clause in clauses]
+
+    if cursor_mark != '*':
+        after = key(json.loads(base64.urlsafe_b64decode(str(cursor_mark))))
+        docs = [doc for doc in docs if after < key(values(doc))]
+    if not docs[:rows]:
+        return docs, cursor_mark
+    last = docs[:rows][-1]
+    return docs, base64.urlsafe_b64encode(json.dumps(values(last)))
+
+
+def _facets(docs, fields, limit, mincount):
+    if isinstance(fields, basestring):
+        fields = [fields]
+    facet_fields = {}
+    for field in fields:
+        counts = {}
+        for doc in docs:
+            for value in _as_strings(doc.get(field)):
+                counts[value] = counts.get(value, 0) + 1
+        items = sorted((item for item in counts.items()
+                        if item[1] >= mincount),
+                       key=lambda item: (-item[1], item[0]))
+        if limit >= 0:
+            items = items[:limit]
+        facet_fields[field] = [part for item in items for part in item]
+    return facet_fields
+
+
+def _project(doc, fields):
+    if '*' in fields:
+        return dict(doc)
+    return dict((field, doc[field]) for field in fields if field in doc)
+
+
+def _is_true(value):
+    return unicode(value).lower() in ('true', 'on', '1')
@@ -0,0 +1,284 @@
+"""Benchmarks of the actions, schemas and helpers the gosh plugin provides.
+
+Loads generated catalogues (see ``catalogue``) into the database of a CKAN
+config, with a fake Solr in place of the real one (see ``fake_solr``), and
+measures each case's latency percentiles, SQL queries and allocations per
+call::
+
+    python -m ckanext.gosh.tests.benchmarks.suite -c test.ini \\
+        [--sizes 1000,10000,100000] [--baseline FILE] [--save-baseline]
+
+The database is wiped and reloaded for every size, so the config must point
+at a throwaway database (its name has to contain "test", or pass
+``--force``). PostgreSQL and SQLite both work.
+
+With a baseline file, the run fails if a case got slower than
+``--tolerance`` allows (p50 or p95), allocates more than that, or runs more
+queries at all. Save a baseline from a known good run on the same machine,
+timings don't carry over between machines.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+class Case(object):
+
+    def __init__(self, name, run, iterations=50):
+        self.name = name
+        self.run = run
+        self.iterations = iterations
+
+
+def _context(user=''):
+    import ckan.model as model
+    return {'model': model, 'session': model.Session, 'user': user,
+            'ignore_auth': True}
+
+
+def cases(catalogue):
+    '''The benchmark cases for a loaded catalogue.'''
+    import ckan.plugins as plugins
+    import ckan.plugins.toolkit as toolkit
+
+    from ckanext.gosh import helpers
+
+    plugin = plugins.get_plugin('gosh')
+    action = toolkit.get_action
+
+    def search(user='', **data_dict):
+        return lambda: action('package_search')(_context(user),
+                                                dict(data_dict))
+
+    def call(name, user='', **data_dict):
+        return lambda: action(name)(_context(user), dict(data_dict))
+
+    package_id = catalogue.package_ids[len(catalogue.package_ids) // 2]
+
+    return [
+        Case('package_search anonymous', search(rows=20)),
+        Case('package_search q + facets', search(
+            q='genome', rows=20,
+            **{'facet.field': ['organization', 'groups', 'tags',
+                               'res_format', 'license_id']})),
+        Case('package_search fl projection', search(
+            rows=100, fl='id name title metadata_modified')),
+        Case('package_search editor private', search(
+            catalogue.editor, rows=20, include_private=True,
+            include_drafts=True)),
+        Case('package_search sysadmin private', search(
+            catalogue.sysadmin, rows=20, include_private=True,
+            include_drafts=True)),
+        Case('package_autocomplete anonymous', call(
+            'package_autocomplete', q='cohort', limit=10)),
+        Case('package_autocomplete user', call(
+            'package_autocomplete', catalogue.editor, q='study 1',
+            limit=10)),
+        Case('gosh_package_show_many 100', call(
+            'gosh_package_show_many', catalogue.editor,
+            ids=catalogue.package_ids[:100]), iterations=20),
+        Case('resource_search format', call(
+            'resource_search', query='format:CSV', limit=100)),
+        Case('resource_search keyset', call(
+            'resource_search', query='name:file', cursor='*', limit=100)),
+        Case('user_list sysadmin', call(
+            'user_list', catalogue.sysadmin, q='bench', order_by='name'),
+             iterations=20),
+        Case('user_list keyset', call(
+            'user_list', catalogue.sysadmin, cursor='*', limit=100)),
+        Case('create_package_schema', plugin.create_package_schema, 500),
+        Case('update_package_schema', plugin.update_package_schema, 500),
+        Case('show_package_schema', plugin.show_package_schema, 500),
+        Case('h.language_options', helpers.language_options, 500),
+        Case('h.get_language_by_code', lambda: helpers.get_language_by_code(
+            'fr'), 500),
+        Case('h.get_package_version', lambda: helpers.get_package_version(
+            package_id), 500),
+    ]
+
+
+class QueryCounter(object):
+    '''Counts the statements sent through an engine.'''
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def measure(case, counter):
+    '''Runs a case and returns its statistics per call.
+
+    Latencies are in milliseconds. Allocations are the bytes allocated per
+    call where ``tracemalloc`` exists, the net number of objects tracked by
+    the garbage collector otherwise.
+    '''
+    import ckan.model as model
+
+    # Warm up caches, as a long running worker would have them
+    for i in range(min(5, case.iterations)):
+        case.run()
+    model.Session.remove()
+
+    timings = []
+    queries = 0
+    gc.collect()
+    gc.disable()
+    try:
+        if tracemalloc:
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+        else:
+            before = gc.get_count()[0]
+        for i in range(case.iterations):
+            start_queries = counter.count
+            start = time.time()
+            case.run()
+            timings.append((time.time() - start) * 1000)
+            queries += counter.count - start_queries
+        if tracemalloc:
+            allocations = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+        else:
+            allocations = gc.get_count()[0] - before
+    finally:
+        gc.enable()
+        model.Session.remove()
+
+    return {'p50': _percentile(timings, 50),
+            'p95': _percentile(timings, 95),
+            'p99': _percentile(timings, 99),
+            'queries': float(queries) / case.iterations,
+            'allocations': float(allocations) / case.iterations}
+
+
+def compare(results, baseline, tolerance):
+    '''Returns a message for every case that regressed against
+    ``baseline``.'''
+    regressions = []
+    for key, stats in sorted(results.items()):
+        expected = baseline.get(key)
+        if not expected:
+            continue
+        for stat in ('p50', 'p95', 'allocations'):
+            limit = expected[stat] * (1 + tolerance)
+            if stats[stat] > limit and stats[stat] - expected[stat] > 0.05:
+                regressions.append('{0}: {1} {2:.2f} > {3:.2f}'.format(
+                    key, stat, stats[stat], expected[stat]))
+        if stats['queries'] > expected['queries']:
+            regressions.append('{0}: queries {1:.1f} > {2:.1f}'.format(
+                key, stats['queries'], expected['queries']))
+    return regressions
+
+
+def _reset_caches():
+    from ckanext.gosh import (autocomplete, facets, helpers, restricted,
+                              scope, search_cache, users)
+
+    helpers.version_cache.clear()
+    helpers.fragment_cache.clear()
+    scope.scope_cache.clear()
+    users.user_list_cache.clear()
+    facets.group_titles.invalidate()
+    restricted.restricted_ids = restricted.RestrictedIds()
+    autocomplete.index = autocomplete.AutocompleteIndex()
+    search_cache.search_cache.invalidate()
+
+
+def _setup(config_path, force):
+    from ckan.lib.cli import load_config
+    load_config(config_path, load_site_user=False)
+
+    import ckan.plugins as plugins
+    from ckan.common import config
+    from ckan.model import meta
+
+    url = meta.engine.url
+    if 'test' not in (url.database or '') and not force:
+        sys.exit('Refusing to wipe database {0!r}, use a test database or '
+                 'pass --force'.format(url.database))
+
+    if not plugins.plugin_loaded('gosh'):
+        plugins.load('gosh')
+    return plugins.get_plugin('gosh'), config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-c', '--config', default=os.environ.get('CKAN_INI'),
+                        help='CKAN config file, defaults to $CKAN_INI')
+    parser.add_argument('--sizes', default='1000',
+                        help='Comma separated catalogue sizes')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown, as a fraction')
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args(argv)
+
+    plugin, config = _setup(args.config, args.force)
+
+    import ckan.model as model
+    import ckanext.gosh.model as gosh_model
+    from ckanext.gosh.tests.benchmarks import catalogue, fake_solr
+
+    solr = fake_solr.install()
+    counter = QueryCounter(model.meta.engine)
+
+    results = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        start = time.time()
+        loaded = catalogue.load(size, solr)
+        gosh_model.setup()
+        plugin.configure(config)
+        _reset_caches()
+        print('Loaded {0} datasets in {1:.1f}s'.format(
+            size, time.time() - start))
+        print('{0:<34} {1:>9} {2:>9} {3:>9} {4:>8} {5:>12}'.format(
+            'case', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'allocations'))
+        for case in cases(loaded):
+            stats = measure(case, counter)
+            results['{0}/{1}'.format(size, case.name)] = stats
+            print('{0:<34} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f} '
+                  '{queries:>8.1f} {allocations:>12.0f}'.format(
+                      case.name, **stats))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Saved baseline to {0}'.format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at {0}, nothing to compare'.format(args.baseline))
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""Tests for actions.py, against the fake Solr."""
+import datetime
+
+import ckan.model as model
+from ckan.common import config
+from ckan.tests import factories, helpers
+
+from ckanext.gosh import actions
+from ckanext.gosh.tests.benchmarks import fake_solr
+
+
+def _context():
+    return {'model': model, 'session': model.Session, 'user': '',
+            'ignore_auth': True}
+
+
+def teardown_module():
+    fake_solr.uninstall()
+
+
+def _solr():
+    solr = fake_solr.install()
+    site_id = config.get('ckan.site_id')
+    for number in range(3):
+        id = 'pkg-{0}'.format(number)
+        solr.add([{'id': id, 'name': 'name-{0}'.format(number),
+                   'site_id': site_id, 'state': 'active',
+                   'capacity': 'public'}])
+    return solr
+
+
+def test_package_search_single_field_projection():
+    _solr()
+    for data_dict, field, values in (
+            ({'fl': 'name'}, 'name', ['name-0', 'name-1', 'name-2']),
+            ({'fl': ['id']}, 'id', ['pkg-0', 'pkg-1', 'pkg-2']),
+            ({'fl': 'id', 'cursor_mark': '*'}, 'id',
+             ['pkg-0', 'pkg-1', 'pkg-2'])):
+        results = actions.package_search(_context(), data_dict)['results']
+        assert sorted(result[field] for result in results) == values
+        assert all(len(result) == 1 for result in results)
+
+
+def test_resource_search_keyset_string_limit():
+    helpers.reset_db()
+    dataset = factories.Dataset()
+    for number in range(3):
+        factories.Resource(package_id=dataset['id'],
+                           name=u'file {0}'.format(number))
+
+    data_dict = {'query': 'name:file', 'cursor': '*', 'limit': '2'}
+    first = actions.resource_search(_context(), data_dict)
+    assert len(first['results']) == 2
+    assert first['next_cursor']
+    second = actions.resource_search(
+        _context(), dict(data_dict, cursor=first['next_cursor']))
+    assert len(second['results']) == 1
+    assert second['next_cursor'] is None
+
+
+def test_metadata_modified_compared_to_the_millisecond():
+    modified = datetime.datetime(2018, 1, 2, 3, 4, 5, 120999)
+    for indexed in ('2018-01-02T03:04:05.12Z', '2018-01-02T03:04:05.120Z',
+                    datetime.datetime(2018, 1, 2, 3, 4, 5, 120000)):
+        assert actions._to_milliseconds(indexed) == \
+            actions._to_milliseconds(modified)
+    assert actions._to_milliseconds('2018-01-02T03:04:05Z') != \
+        actions._to_milliseconds(modified)
+    assert actions._to_milliseconds('not a date') is None
@@ -0,0 +1,31 @@
+"""Tests for autocomplete.py."""
+from ckanext.gosh.autocomplete import AutocompleteIndex
+
+
+def _index():
+    index = AutocompleteIndex()
+    index.update('1', u'annual-report', u'Annual Report', False, False)
+    index.update('2', u'birth-rates', u'Annual birth rates', False, False)
+    index.update('3', u'annex', u'Annex', False, True)
+    index.update('4', u'annotations', u'Annotations', True, False)
+    return index
+
+
+def test_search_names_before_titles():
+    results = _index().search(u'ANN', include_restricted=True)
+    assert results == [(u'annex', u'Annex'),
+                       (u'annual-report', u'Annual Report'),
+                       (u'birth-rates', u'Annual birth rates')]
+
+
+def test_search_hides_restricted_and_private():
+    results = _index().search(u'ann')
+    assert [name for name, _ in results] == [u'annual-report', u'birth-rates']
+
+
+def test_search_limit_and_updates():
+    index = _index()
+    assert len(index.search(u'ann', limit=1)) == 1
+    index.update('2', u'birth-rates', u'Births', False, False)
+    index.remove('1')
+    assert index.search(u'ann') == []
@@ -0,0 +1,42 @@
+"""Tests for the benchmark suite's fake Solr and baseline comparison."""
+from ckanext.gosh.tests.benchmarks import fake_solr, suite
+
+
+def _solr():
+    solr = fake_solr.FakeSolr()
+    solr.add([
+        {'id': 'a', 'name': 'alpha', 'capacity': 'public', 'state': 'active',
+         'gosh_restricted': False, 'tags': ['x', 'y']},
+        {'id': 'b', 'name': 'beta', 'capacity': 'private', 'owner_org': 'o1',
+         'state': 'draft', 'gosh_restricted': True, 'tags': ['x']},
+    ])
+    return solr
+
+
+def _ids(solr, **params):
+    return sorted(doc['id'] for doc in solr.search(**params).docs)
+
+
+def test_fake_solr_filters():
+    solr = _solr()
+    assert _ids(solr, fq=['+state:active']) == ['a']
+    assert _ids(solr, fq=['-gosh_restricted:true']) == ['a']
+    assert _ids(solr, fq=['(capacity:"public" OR owner_org:(o1 OR o2))',
+                          ' +state:(active OR draft)']) == ['a', 'b']
+    assert _ids(solr, q='name:beta') == ['b']
+    assert _ids(solr, q='alph') == ['a']
+
+
+def test_fake_solr_facets():
+    results = _solr().search(**{'facet': 'true', 'facet.field': ['tags']})
+    assert results.hits == 2
+    assert results.facets['facet_fields']['tags'] == ['x', 2, 'y', 1]
+
+
+def test_compare():
+    baseline = {'1000/case': {'p50': 1.0, 'p95': 2.0, 'allocations': 100,
+                              'queries': 1}}
+    same = {'1000/case': dict(baseline['1000/case'], p95=2.2)}
+    assert suite.compare(same, baseline, 0.25) == []
+    slower = {'1000/case': dict(baseline['1000/case'], p95=3.0, queries=2)}
+    assert len(suite.compare(slower, baseline, 0.25)) == 2
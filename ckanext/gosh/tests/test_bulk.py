@@ -0,0 +1,19 @@
+"""Tests for bulk.py."""
+import ckan.model as model
+from ckan.tests import helpers
+
+from ckanext.gosh import bulk
+
+
+def test_validate_many_reports_field_errors():
+    helpers.reset_db()
+    context = {'model': model, 'session': model.Session, 'user': ''}
+    records = [('package_create', {'title': u'No name'}),
+               ('package_create', {'name': u'has-a-name'})]
+    results = bulk.validate_many(context, records, workers=2)
+    data, errors = results[0]
+    # Messages of core validators, not a missing translator
+    assert 'name' in errors
+    assert '__all__' not in errors
+    data, errors = results[1]
+    assert 'name' not in errors
@@ -0,0 +1,77 @@
+"""Tests for export.py, against the fake Solr."""
+import json
+
+from ckan.common import config
+from ckan.lib.search.common import SearchQueryError
+
+from ckanext.gosh import export
+from ckanext.gosh.scope import AuthScope
+from ckanext.gosh.tests.benchmarks import fake_solr
+
+
+def teardown_module():
+    fake_solr.uninstall()
+
+
+def _solr():
+    solr = fake_solr.install()
+    site_id = config.get('ckan.site_id')
+    for number in range(7):
+        id = 'pkg-{0}'.format(number)
+        solr.add([{
+            'id': id, 'name': id, 'title': u'Dataset {0}'.format(number),
+            'site_id': site_id, 'state': 'active',
+            'capacity': 'private' if number == 3 else 'public',
+            'extras_restricted': '1' if number == 5 else '0',
+            'tags': ['a', 'b'],
+            'validated_data_dict': json.dumps({'id': id}),
+        }])
+    return solr
+
+
+def test_export_jsonl_pages():
+    _solr()
+    lines = list(export.export_lines(AuthScope(None), 'jsonl',
+                                     batch_size=2))
+    ids = [json.loads(line)['id'] for line in lines]
+    # Private and restricted datasets are left out
+    assert ids == ['pkg-0', 'pkg-1', 'pkg-2', 'pkg-4', 'pkg-6']
+
+
+def test_export_csv():
+    _solr()
+    lines = list(export.export_lines(AuthScope('someone', 'user-id'), 'csv',
+                                     fields=['id', 'tags'], batch_size=3))
+    assert lines[0] == 'id,tags\r\n'
+    assert lines[1] == 'pkg-0,a;b\r\n'
+    assert len(lines) == 7
+
+
+def test_cursor_search_pages():
+    _solr()
+    query = {'fq': '+capacity:public', 'rows': 2, 'fl': 'id',
+             'sort': export.cursor_sort('metadata_modified desc')}
+    assert query['sort'] == 'metadata_modified desc, id asc'
+    ids = []
+    cursor_mark = '*'
+    while True:
+        count, results, facets, next_cursor_mark = export.cursor_search(
+            query, cursor_mark)
+        ids.extend(results)
+        if next_cursor_mark == cursor_mark:
+            break
+        cursor_mark = next_cursor_mark
+    assert count == 6
+    assert sorted(ids) == ['pkg-0', 'pkg-1', 'pkg-2', 'pkg-4', 'pkg-5',
+                           'pkg-6']
+
+
+def test_cursor_search_rejects_other_solr_parameters():
+    _solr()
+    query = {'fl': 'id', 'sort': 'id asc', 'shards': 'elsewhere:8983/solr'}
+    try:
+        export.cursor_search(query, '*')
+    except SearchQueryError:
+        pass
+    else:
+        assert False, 'shards reached Solr'
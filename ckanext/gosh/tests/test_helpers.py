@@ -0,0 +1,70 @@
+"""Tests for helpers.py."""
+import json
+import os
+import tempfile
+
+import ckanext.gosh.helpers as helpers
+
+
+def _registry(languages):
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        f.write(json.dumps(languages))
+    return helpers.LanguageRegistry(path), path
+
+
+def test_language_registry_lookup():
+    registry, path = _registry([{'code': 'en', 'language': 'English'},
+                                {'code': 'nl', 'language': 'Dutch'}])
+    try:
+        assert [l['code'] for l in registry.languages()] == ['en', 'nl']
+        assert registry.get('nl')['language'] == 'Dutch'
+        assert registry.get('xx') is None
+    finally:
+        os.remove(path)
+
+
+def test_language_registry_reloads_on_mtime_change():
+    registry, path = _registry([{'code': 'en', 'language': 'English'}])
+    registry.check_interval = 0
+    try:
+        assert registry.get('de') is None
+        with open(path, 'w') as f:
+            f.write(json.dumps([{'code': 'de', 'language': 'German'}]))
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        assert registry.get('de')['language'] == 'German'
+    finally:
+        os.remove(path)
+
+
+def test_cached_fragment():
+    renders = []
+
+    def caller():
+        renders.append(1)
+        return u'<tr>{0}</tr>'.format(len(renders))
+
+    helpers.fragment_cache.clear()
+    pkg_dict = {'id': 'pkg', 'metadata_modified': '2017-01-01T00:00:00'}
+    assert helpers.cached_fragment('info', pkg_dict, caller) == u'<tr>1</tr>'
+    assert helpers.cached_fragment('info', pkg_dict, caller) == u'<tr>1</tr>'
+
+    pkg_dict['metadata_modified'] = '2017-01-02T00:00:00'
+    assert helpers.cached_fragment('info', pkg_dict, caller) == u'<tr>2</tr>'
+
+    helpers.fragment_cache.pop('pkg')
+    assert helpers.cached_fragment('info', pkg_dict, caller) == u'<tr>3</tr>'
+
+
+def test_cached_fragment_rereads_version():
+    helpers.fragment_cache.clear()
+    helpers.version_cache.set('pkg', 1)
+    pkg_dict = {'id': 'pkg', 'metadata_modified': '2017-01-01T00:00:00'}
+    helpers.cached_fragment('info', pkg_dict, lambda: u'')
+    assert helpers.version_cache.get('pkg') is None
+
+    helpers.version_cache.set('pkg', 2)
+    helpers.cached_fragment('info', pkg_dict, lambda: u'')
+    assert helpers.version_cache.get('pkg') == 2
+    helpers.version_cache.clear()
@@ -0,0 +1,35 @@
+"""Tests for metrics.py."""
+from ckanext.gosh.metrics import Metrics
+
+
+def test_span_disabled():
+    metrics = Metrics()
+    with metrics.span('stage'):
+        pass
+    assert metrics.snapshot() == {}
+
+
+def test_timed():
+    metrics = Metrics()
+    metrics.enabled = True
+
+    @metrics.timed('stage')
+    def function(value):
+        return value
+
+    assert function(1) == 1
+    histogram = metrics.snapshot()['gosh_stage_seconds']['stage']
+    assert histogram['count'] == 1
+    assert histogram['buckets'][-1][1] == 1
+
+
+def test_prometheus():
+    metrics = Metrics()
+    metrics.observe('gosh_stage_queries', 'package_search', 3)
+    text = metrics.prometheus()
+    assert '# TYPE gosh_stage_queries histogram' in text
+    assert 'gosh_stage_queries_bucket{stage="package_search",le="2"} 0' \
+        in text
+    assert 'gosh_stage_queries_bucket{stage="package_search",le="5"} 1' \
+        in text
+    assert 'gosh_stage_queries_count{stage="package_search"} 1' in text
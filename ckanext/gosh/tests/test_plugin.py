@@ -2,4 +2,16 @@
 import ckanext.gosh.plugin as plugin
 
 def test_plugin():
-    pass
\ No newline at end of file
+    pass
+
+def test_validate_uses_bulk_validated_data():
+    gosh = plugin.GoshPlugin()
+    data = {'name': u'validated'}
+    context = {'gosh_validated': data}
+    assert gosh.validate(context, {'name': u'raw'}, {}, 'package_show') \
+        is None
+    assert gosh.validate(context, {'name': u'raw'}, {},
+                         'package_update') == (data, {})
+    assert 'gosh_validated' not in context
+    assert gosh.validate(context, {'name': u'raw'}, {},
+                         'package_create') is None
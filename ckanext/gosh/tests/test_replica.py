@@ -0,0 +1,108 @@
+"""Tests for replica.py, with two SQLite databases standing in for the
+primary and the replica."""
+import os
+import shutil
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from ckanext.gosh.replica import ReadReplica
+
+
+def _database(directory, name):
+    url = 'sqlite:///' + os.path.join(directory, name + '.db')
+    engine = sqlalchemy.create_engine(url)
+    engine.execute('CREATE TABLE source (name TEXT)')
+    engine.execute('INSERT INTO source VALUES (?)', name)
+    return url, engine
+
+
+def _databases():
+    directory = tempfile.mkdtemp()
+    primary_url, primary_engine = _database(directory, 'primary')
+    replica_url, replica_engine = _database(directory, 'replica')
+    replica_engine.dispose()
+    primary = scoped_session(sessionmaker(bind=primary_engine))
+    replica = ReadReplica(primary)
+    replica.configure({'ckanext.gosh.replica.url': replica_url})
+    return directory, replica
+
+
+source_table = sqlalchemy.Table(
+    'source', sqlalchemy.MetaData(),
+    sqlalchemy.Column('name', sqlalchemy.Text))
+
+
+def _source(session):
+    return session.execute('SELECT name FROM source').scalar()
+
+
+def _cleanup(directory, replica):
+    replica.dispose()
+    replica.primary.remove()
+    shutil.rmtree(directory)
+
+
+def test_reads_from_replica():
+    directory, replica = _databases()
+    try:
+        assert replica.run(_source) == 'replica'
+        replica.configure({})
+        assert not replica.enabled
+        assert replica.run(_source) == 'primary'
+    finally:
+        _cleanup(directory, replica)
+
+
+def test_recent_write_reads_from_primary():
+    directory, replica = _databases()
+    try:
+        replica.last_write = time.time()
+        assert replica.run(_source) == 'primary'
+        replica.last_write = time.time() - replica.max_lag
+        assert replica.run(_source) == 'replica'
+    finally:
+        _cleanup(directory, replica)
+
+
+def test_lagging_replica_reads_from_primary():
+    directory, replica = _databases()
+    try:
+        replica.measure_lag = lambda: replica.max_lag + 1
+        assert replica.run(_source) == 'primary'
+        replica.measure_lag = lambda: None
+        replica._checked = 0
+        assert replica.run(_source) == 'primary'
+    finally:
+        _cleanup(directory, replica)
+
+
+def test_failing_replica_query_retries_on_primary():
+    directory, replica = _databases()
+    try:
+        assert replica.run(_source) == 'replica'
+        replica.remove()
+        replica.engine.execute('DROP TABLE source')
+        assert replica.run(_source) == 'primary'
+        # Until the next lag check
+        assert replica.session() is replica.primary()
+    finally:
+        _cleanup(directory, replica)
+
+
+def test_runs_queries_built_on_another_session():
+    directory, replica = _databases()
+    try:
+        query = replica.primary.query(source_table.c.name)
+        for enabled, name in ((True, 'replica'), (False, 'primary')):
+            if not enabled:
+                replica.configure({})
+            assert replica.run(
+                lambda session: query.with_session(session).all()) \
+                == [(name,)]
+            assert replica.run(
+                lambda session: query.with_session(session).count()) == 1
+    finally:
+        _cleanup(directory, replica)
@@ -0,0 +1,14 @@
+"""Tests for restricted.py."""
+from ckanext.gosh import restricted
+
+
+def test_is_restricted_dict():
+    assert restricted.is_restricted_dict({'restricted': '1'})
+    assert not restricted.is_restricted_dict({'restricted': '0'})
+    assert restricted.is_restricted_dict(
+        {'extras': [{'key': 'restricted', 'value': '1'}]})
+    assert not restricted.is_restricted_dict({'extras': []})
+
+
+def test_can_view_logged_in():
+    assert restricted.can_view('id', 'someone', {'restricted': '1'})
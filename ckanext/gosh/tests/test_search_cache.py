@@ -0,0 +1,33 @@
+"""Tests for search_cache.py."""
+import ckan.model as model
+
+from ckanext.gosh.search_cache import SearchCache, search_cache
+
+
+def _cache(size=2):
+    cache = SearchCache()
+    cache.configure({'ckanext.gosh.search_cache': 'true',
+                     'ckanext.gosh.search_cache.size': size})
+    return cache
+
+
+def test_generation_is_not_evicted():
+    cache = _cache()
+    key = cache.key({'q': 'water'}, 'anonymous')
+    for number in range(5):
+        cache.set('gosh:search:{0}'.format(number), {})
+    assert cache.key({'q': 'water'}, 'anonymous') == key
+
+
+def test_invalidates_on_commit_only():
+    search_cache.configure({'ckanext.gosh.search_cache': 'true'})
+    key = search_cache.key({'q': 'water'}, 'anonymous')
+
+    search_cache.invalidate_on_commit()
+    assert search_cache.key({'q': 'water'}, 'anonymous') == key
+    model.Session.rollback()
+    assert search_cache.key({'q': 'water'}, 'anonymous') == key
+
+    search_cache.invalidate_on_commit()
+    model.Session.commit()
+    assert search_cache.key({'q': 'water'}, 'anonymous') != key
@@ -0,0 +1,57 @@
+"""Tests for warmup.py."""
+from ckanext.gosh import warmup
+
+
+def _steps(ran):
+    def step(name):
+        def run(plugin):
+            ran.append((name, plugin))
+        return name, run
+
+    def failing(plugin):
+        raise ValueError('cold')
+
+    return (step('first'), ('failing', failing), step('last'))
+
+
+def _warm_up_with(steps, function):
+    original = warmup.STEPS
+    warmup.STEPS = steps
+    warmup.reset()
+    try:
+        return function()
+    finally:
+        warmup.STEPS = original
+        warmup.reset()
+
+
+def test_warm_up_once():
+    plugin = object()
+    ran = []
+
+    def check():
+        timings = warmup.warm_up(plugin)
+        assert set(timings) == set(['first', 'failing', 'last'])
+        assert warmup.warm_up(plugin) == {}
+
+    _warm_up_with(_steps(ran), check)
+    # A failing step doesn't stop the others
+    assert ran == [('first', plugin), ('last', plugin)]
+
+
+def test_middleware_warms_up_before_first_request():
+    plugin = object()
+    ran = []
+    calls = []
+
+    def app(environ, start_response):
+        calls.append(len(ran))
+        return []
+
+    def check():
+        middleware = warmup.WarmupMiddleware(app, plugin)
+        middleware({}, None)
+        middleware({}, None)
+
+    _warm_up_with(_steps(ran), check)
+    assert calls == [2, 2]
@@ -0,0 +1,87 @@
+import hashlib
+import logging
+
+from sqlalchemy import event
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.gosh.cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+# Orderings the lean query can serve, others are left to core user_list
+LEAN_ORDER_BY = ('name', 'fullname', 'created')
+
+# user_list API pages by (q, order_by, cursor, limit)
+user_list_cache = LRUCache(maxsize=500, ttl=30)
+
+
+def lean_query(q=None, order_by='name', user=None, session=None):
+    '''Users with only the columns listing them needs.
+
+    Unlike core user_list there are no per-user counts of edits and
+    datasets, so the cost of a page does not depend on the number of users.
+    '''
+    session = session or model.Session
+    query = session.query(model.User.id, model.User.name,
+                          model.User.fullname, model.User.email)
+    if q:
+        query = model.User.search(q, query, user_name=user)
+    query = query.filter(model.User.state != model.State.DELETED)
+    query = query.order_by(getattr(model.User, order_by or 'name'),
+                           model.User.name)
+    return query
+
+
+def keyset_page(q=None, cursor=None, limit=100, user=None, session=None):
+    '''One page of users ordered by name, starting after ``cursor``.'''
+    key = (q, cursor, limit)
+    page = user_list_cache.get(key)
+    if page is None:
+        query = lean_query(q, user=user, session=session)
+        if cursor not in (None, '', '*'):
+            query = query.filter(model.User.name > cursor)
+        rows = query.limit(limit).all()
+        page = {
+            'results': [{'id': row.id,
+                         'name': row.name,
+                         'display_name': row.fullname or row.name}
+                        for row in rows],
+            'next_cursor': rows[-1].name if len(rows) == limit else None,
+        }
+        user_list_cache.set(key, page)
+    return page
+
+
+def linked_users(rows, maxlength=0, avatar=20):
+    '''Renders user links like h.linked_user, for a whole page of users.
+
+    Takes the rows of ``lean_query`` (or core user_list rows) and needs no
+    query per user.
+    '''
+    h = toolkit.h
+    links = []
+    for row in rows:
+        user = getattr(row, 'User', None) or row
+        name = user.name if model.User.VALID_NAME.match(user.name) \
+            else user.id
+        display_name = user.fullname or user.name
+        if maxlength and len(display_name) > maxlength:
+            display_name = display_name[:maxlength] + '...'
+        email = (user.email or '').strip().lower().encode('utf8')
+        links.append(toolkit.literal(u'{icon} {link}'.format(
+            icon=h.gravatar(email_hash=hashlib.md5(email).hexdigest(),
+                            size=avatar),
+            link=h.link_to(display_name,
+                           h.url_for(controller='user', action='read',
+                                     id=name)))))
+    return links
+
+
+def _invalidate(mapper, connection, target):
+    user_list_cache.clear()
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(model.User, _event, _invalidate)
@@ -0,0 +1,132 @@
+'''Fills the plugin's per-worker caches before the first request needs them.
+
+A cold worker otherwise pays for reading the language list, building the
+package schemas, loading the license register and the group title map,
+reading the restricted dataset ids, importing email_validator and, with the
+memory autocomplete engine, building the autocomplete index on the requests
+that happen to come first.
+
+``ckanext.gosh.warmup`` picks when this happens:
+
+``first_request`` (the default)
+    In each worker, on its first request. Processes that never serve a
+    request, such as paster commands, don't pay for it.
+``configure``
+    At the end of ``IConfigurable.configure``, which also runs for paster
+    commands and tests. With a server that loads the app before forking
+    workers (e.g. ``gunicorn --preload`` or uWSGI without ``lazy-apps``)
+    the caches are built once and shared.
+``off``
+    Caches fill on demand, as before.
+'''
+import logging
+import threading
+import time
+
+import ckan.model as model
+from ckan.common import config
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_done = False
+
+
+def _languages(plugin):
+    from ckanext.gosh import helpers
+    helpers.language_registry.languages()
+
+
+def _schemas(plugin):
+    plugin._build_schemas()
+
+
+def _licenses(plugin):
+    # Only the register: license titles are translated, and there is no
+    # locale to translate them to yet
+    model.Package.get_license_register()
+
+
+def _group_titles(plugin):
+    from ckanext.gosh import facets
+    facets.group_titles.get_many([])
+
+
+def _restricted_ids(plugin):
+    from ckanext.gosh import restricted
+    restricted.restricted_ids.ids()
+
+
+def _email_validator(plugin):
+    from ckanext.gosh import plugin as gosh_plugin
+    gosh_plugin.load_email_validator()
+
+
+def _autocomplete(plugin):
+    from ckanext.gosh import autocomplete
+    if config.get('ckanext.gosh.autocomplete_engine') == 'memory' and \
+            not autocomplete.index.ready:
+        autocomplete.index.build()
+
+
+STEPS = (
+    ('languages', _languages),
+    ('schemas', _schemas),
+    ('licenses', _licenses),
+    ('group titles', _group_titles),
+    ('restricted ids', _restricted_ids),
+    ('email validator', _email_validator),
+    ('autocomplete index', _autocomplete),
+)
+
+
+def warm_up(plugin):
+    '''Runs every step once, logging how long each took.
+
+    A failing step is logged and skipped, its cache fills on demand later.
+    Returns the milliseconds taken by each step.
+    '''
+    global _done
+    with _lock:
+        if _done:
+            return {}
+        _done = True
+
+    timings = {}
+    start = time.time()
+    try:
+        for name, step in STEPS:
+            step_start = time.time()
+            try:
+                step(plugin)
+            except Exception:
+                log.warning('Could not warm up the %s', name, exc_info=True)
+            timings[name] = (time.time() - step_start) * 1000
+    finally:
+        model.Session.remove()
+
+    log.info('Warmed up the gosh caches in %.0fms (%s)',
+             (time.time() - start) * 1000,
+             ', '.join('{0} {1:.0f}ms'.format(name, timings[name])
+                       for name, step in STEPS))
+    return timings
+
+
+def reset():
+    '''Lets ``warm_up`` run again, e.g. after the caches were cleared.'''
+    global _done
+    with _lock:
+        _done = False
+
+
+class WarmupMiddleware(object):
+    '''Warms up the caches before the first request a worker handles.'''
+
+    def __init__(self, app, plugin):
+        self.app = app
+        self.plugin = plugin
+
+    def __call__(self, environ, start_response):
+        if not _done:
+            warm_up(self.plugin)
+        return self.app(environ, start_response)
@@ -82,6 +82,9 @@ setup(
         [ckan.plugins]
         gosh=ckanext.gosh.plugin:GoshPlugin
 
+        [paste.paster_command]
+        gosh=ckanext.gosh.commands:GoshCommand
+
         [babel.extractors]
         ckan = ckan.lib.extract:extract_ckan
     ''',